@@ -7,6 +7,10 @@ Usage:
   eol FILE...             # list EOL-style of file(s)
   eol -c NAME FILE...     # convert file(s) to given EOL-style
   eol -f NAME FILE...     # find files with the given EOL-style
+  eol --files-from LIST   # process files listed in LIST ('-' for stdin)
+  eol --check-final-eol FILE...  # list files w/o exactly one final EOL
+  eol --fix-final-eol FILE...    # fix file(s) to end with one EOL
+  eol --merge JSON-FILE...       # merge `eol --json` outputs, e.g. of shards
 
 `eol` is a tool for working with EOLs in text files: determining the
 EOL type and converting between types. `eol.py` can also be used as
@@ -47,6 +51,9 @@ import errno
 
 log = logging.getLogger("eol")
 
+class Error(Exception):
+    pass
+
 
 # The EOL types.
 CR = "\r"
@@ -98,8 +105,12 @@ except NameError:
     _BASESTRING = str
 if sys.version_info[0] > 2:
     _BYTES_NULL = bytes([0])
+    _BYTES_EMPTY = bytes()
+    _BYTES_CRLF = bytes([13, 10])
 else:
     _BYTES_NULL = '\0'
+    _BYTES_EMPTY = ''
+    _BYTES_CRLF = '\r\n'
 
 
 
@@ -192,20 +203,127 @@ def eol_info_from_text(text):
         numCRLFs = text.count("\r\n")
         numCRs   = text.count("\r") - numCRLFs
         numLFs   = text.count("\n") - numCRLFs
+    return _eol_info_from_counts(numCRLFs, numCRs, numLFs)
 
-    if numCRLFs == numLFs == numCRs == 0:
-        return (None, NATIVE)
+def eol_info_from_texts(texts):
+    r"""eol_info_from_texts(TEXTS) -> [(EOL, SUGGESTED-EOL), ...]
 
-    # One a tie, prefer the native EOL.
-    eols = [(numCRLFs, CRLF == NATIVE, CRLF),
-            (numCRs,   CR   == NATIVE, CR),
-            (numLFs,   LF   == NATIVE, LF)]
-    eols.sort()
+    Return EOL info for each of the given texts, in the given order. This
+    is equivalent to:
+        [eol_info_from_text(text) for text in texts]
+    but cheaper for large batches of small texts. If NumPy is available a
+    big batch of small bytes texts is counted in one pass over the
+    concatenated texts. See eol_info_from_text() docstring for details.
 
-    if eols[0][0] or eols[1][0]:
-        return (MIXED, eols[-1][-1])
+        >>> eol_info_from_texts(['foo\nbar', 'foo\r\nbar', 'a\rb\r'])
+        [('\n', '\n'), ('\r\n', '\r\n'), ('\r', '\r')]
+        >>> eol_info_from_texts([])
+        []
+    """
+    texts = list(texts)
+    counts = None
+    if len(texts) >= _NUMPY_MIN_TEXTS and sys.version_info[0] > 2:
+        total_size = 0
+        for text in texts:
+            if type(text) != bytes:
+                break
+            total_size += len(text)
+        else:
+            if total_size <= _NUMPY_MAX_MEAN_SIZE * len(texts):
+                counts = _eol_counts_from_texts_numpy(texts)
+    if counts is None:
+        counts = []
+        append = counts.append
+        for text in texts:
+            cr, lf, crlf = _eol_chars_from_text(text)
+            numCRLFs = text.count(crlf)
+            append((numCRLFs, text.count(cr) - numCRLFs,
+                    text.count(lf) - numCRLFs))
+    info_from_counts = _eol_info_from_counts
+    return [info_from_counts(*c) for c in counts]
+
+def final_eol_info_from_text(text):
+    r"""final_eol_info_from_text(TEXT) -> (FINAL-EOL, NUM-TRAILING-BLANK-LINES)
+
+    Return a 2-tuple containing:
+    1) The EOL the text ends with: one of CR, LF, CRLF or None if the
+       last line is not terminated.
+    2) The number of blank (EOL-only) lines trailing the last line of
+       content.
+
+    Only the trailing EOL chars of the text are looked at, so this is
+    cheap to call on the same content passed to eol_info_from_text().
+
+        >>> final_eol_info_from_text('foo\nbar\n')
+        ('\n', 0)
+        >>> final_eol_info_from_text('foo\nbar')
+        (None, 0)
+        >>> final_eol_info_from_text('foo\r\n\r\n\r\n')
+        ('\r\n', 2)
+        >>> final_eol_info_from_text('\n\n')
+        ('\n', 2)
+        >>> final_eol_info_from_text('')
+        (None, 0)
+    """
+    cr, lf, crlf = _eol_chars_from_text(text)
+    i = len(text)
+    while i and text[i-1:i] in (cr, lf):
+        i -= 1
+    tail = text[i:]
+    if not tail:
+        return (None, 0)
+    num_crlfs = tail.count(crlf)
+    num_eols = tail.count(cr) + tail.count(lf) - num_crlfs
+    if tail.endswith(crlf):
+        final_eol = CRLF
+    elif tail.endswith(lf):
+        final_eol = LF
     else:
-        return (eols[-1][-1], eols[-1][-1])
+        final_eol = CR
+    if i:
+        # The first EOL in the tail terminates the last line of content.
+        num_eols -= 1
+    return (final_eol, num_eols)
+
+def fix_text_final_eol(text, eol=None):
+    r"""fix_text_final_eol(TEXT[, EOL]) -> fixed text
+
+    Return the text terminated by exactly one EOL, i.e. with trailing
+    blank lines removed and a missing final EOL added.
+
+        "eol" is the EOL to add if the last line is not terminated. If
+            not given (or None) the suggested EOL for the text is used.
+
+    An existing final EOL is kept as is. Text with no content other than
+    EOLs is emptied.
+
+        >>> fix_text_final_eol('foo\nbar')
+        'foo\nbar\n'
+        >>> fix_text_final_eol('foo\r\nbar\r\n\r\n\n')
+        'foo\r\nbar\r\n'
+        >>> fix_text_final_eol('foo', CRLF)
+        'foo\r\n'
+        >>> fix_text_final_eol('\n\n')
+        ''
+    """
+    cr, lf, crlf = _eol_chars_from_text(text)
+    i = len(text)
+    while i and text[i-1:i] in (cr, lf):
+        i -= 1
+    if not i:
+        return text[:0]
+    tail = text[i:]
+    if tail.startswith(crlf):
+        final_eol = crlf
+    elif tail:
+        final_eol = tail[:1]
+    else:
+        if eol is None:
+            eol = eol_info_from_text(text)[1]
+        if eol not in (LF, CRLF, CR):
+            raise ValueError("illegal EOL: %r" % eol)
+        final_eol = {CR: cr, LF: lf, CRLF: crlf}[eol]
+    return text[:i] + final_eol
 
 def eol_info_from_stream(stream):
     """eol_info_from_stream(STREAM) -> (EOL, SUGGESTED-EOL)
@@ -215,50 +333,187 @@ def eol_info_from_stream(stream):
     """
     return eol_info_from_text(stream.read())
 
-def eol_info_from_path(path):
+def eol_info_from_path(path, jobs=1, chunk_size=64 * 1024 * 1024):
     """eol_info_from_stream(PATH) -> (EOL, SUGGESTED-EOL)
 
     Return EOL info for the given file path.
     See eol_info_from_text() docstring for details.
+
+    If "jobs" isn't 1, a file of at least two "chunk_size"s is split into
+    byte ranges of about that size that are counted by a pool of "jobs"
+    processes (0 or None for one per available CPU), instead of being
+    read whole.
+
+    See enable_eol_info_cache() to cache results in-process.
     """
-    fin = open(path, "rb")
-    try:
-        content = fin.read()
-    finally:
-        fin.close()
-    return eol_info_from_text(content)
+    if jobs != 1:
+        size = os.stat(path).st_size
+        if size >= 2 * chunk_size:
+            counts = [0, 0, 0]
+            for range_counts in _map_path_ranges(_eol_counts_from_path_range,
+                    path, size, jobs, chunk_size):
+                counts = [c + rc for c, rc in zip(counts, range_counts)]
+            return _eol_info_from_counts(*counts)
+    if _eol_info_memo is not None:
+        return _eol_info_memo.eol_info_from_path(path)
+    return eol_info_from_text(_read_path(path))
+
+def enable_eol_info_cache(maxsize=1024):
+    """Cache eol_info_from_path() results in-process, for up to "maxsize"
+    files (least recently used ones are dropped first).
+
+    This is for long-running processes (e.g. an editor backend) that ask
+    about the same files over and over. A cached result is only used if
+    the file's `os.stat()` signature (size, mtime, ctime, inode) hasn't
+    changed, so a repeat query costs a `stat()` instead of a read. It is
+    safe to use from multiple threads. Calling this again starts a new,
+    empty cache.
+    """
+    global _eol_info_memo
+    _eol_info_memo = _EolInfoMemo(maxsize)
+
+def disable_eol_info_cache():
+    """Stop caching eol_info_from_path() results and drop the cache."""
+    global _eol_info_memo
+    _eol_info_memo = None
+
+def eol_info_cache_info():
+    """eol_info_cache_info() -> (HITS, MISSES, MAXSIZE, CURRSIZE)
+
+    Return the counters of the eol_info_from_path() cache (as with
+    `functools.lru_cache`), or None if it isn't enabled.
+    """
+    memo = _eol_info_memo
+    if memo is None:
+        return None
+    return memo.info()
 
 def eol_info_from_path_patterns(path_patterns, recursive=False,
-                                includes=[], excludes=[]):
+                                includes=[], excludes=[], final_eol=False,
+                                walk_threads=0, ordered=True,
+                                skip_vcs_dirs=False, respect_gitignore=False,
+                                git_index=False, skip_dupes=False,
+                                min_size=None, max_size=None,
+                                inode_order=False, cache=None, jobs=1,
+                                pool="thread", read_ahead=0,
+                                device_jobs=None, shard=None,
+                                mmap_size=16 * 1024 * 1024,
+                                stream_size=256 * 1024 * 1024):
     """Generate EOL info for the given paths.
 
     Yields 3-tuples: (PATH, EOL, SUGGESTED-EOL)
     See eol_info_from_text() docstring for details.
+
+    If "final_eol" is true, 5-tuples are yielded instead:
+        (PATH, EOL, SUGGESTED-EOL, FINAL-EOL, NUM-TRAILING-BLANK-LINES)
+    from the same read of each file. See final_eol_info_from_text().
+
+    "walk_threads", "ordered", "skip_vcs_dirs" and "respect_gitignore"
+    control how dirs are walked in recursive searches. If "git_index" is
+    true, the files tracked by git are listed from the git index instead
+    of walking dirs. If "skip_dupes" is true, each dir and file is only
+    visited once (going by `(st_dev, st_ino)`), even if reached via
+    overlapping path patterns, symlinks or hardlinks. A file reached via
+    a symlink is then reported under its own path if that is reached
+    too.
+
+    "min_size" and "max_size", if given, are the size limits (in bytes,
+    inclusive) for files to be scanned. These and the result for an
+    empty file come from the `stat()` info the dir walk gets anyway, so
+    skipped and empty files are never opened. See
+    _paths_from_path_patterns() for details.
+
+    If "inode_order" is true, files are read in batches in inode order,
+    which can be a lot faster on a cold cache on spinning disks. Results
+    are still yielded in the usual order.
+
+    "cache", if given, is the path to a persistent scan cache file (it is
+    created if need be). Only files whose `stat()` signature changed since
+    their result was cached are read, and dirs that haven't changed aren't
+    listed again. `Error` is raised if there is a file at that path that
+    isn't an eol scan cache. See `_ScanCache` for details.
+
+    "jobs" is the number of files to read and scan at a time (default 1).
+    If 0 or None, it is the number of CPUs available to this process
+    (taking cgroup CPU limits into account). "pool" is "thread" (the
+    default) or "process" for the kind of workers to use: processes also
+    spread the CPU work over cores. Results are still yielded in the
+    usual order.
+
+    "device_jobs", if given, maps a device (a path on it, or its
+    `st_dev`) to the number of files to read from it at a time, instead
+    of "jobs", e.g. `{"/mnt/nfs": 16, "/mnt/usb": 1}`. Each device then
+    gets its own pool of workers, so a slow device doesn't hold up (or
+    get overloaded by) the workers for the others.
+
+    With "jobs" of 1, "read_ahead" threads (default 0: none) can read the
+    next files while the current one is scanned, which hides much of the
+    latency of network filesystems. (Not used with "inode_order".)
+    Neither "read_ahead" nor "inode_order" reads files of "mmap_size"
+    bytes or more ahead of time: those are mapped or streamed when they
+    are scanned.
+
+    "shard", if given, is an (I, N) 2-tuple: only the files in shard I
+    (1-based) of N are scanned, going by a hash of their path. This is
+    for splitting a scan over N machines: given the same arguments, the
+    shards are disjoint and cover all files. Other files are only
+    walked past.
+
+    How a file is read depends on its size: whole (into a reused buffer
+    where possible) if under "mmap_size" bytes, else mapped into memory
+    and scanned a window at a time, or, from "stream_size" bytes (or on a
+    network filesystem), read and scanned a chunk at a time. See
+    `_IOStrategy`.
     """
-    from os.path import islink
     assert not isinstance(path_patterns, _BASESTRING), \
         "'path_patterns' must be a sequence, not a string: %r" % path_patterns
-    for path in _paths_from_path_patterns(path_patterns,
-                                          recursive=recursive,
-                                          includes=includes,
-                                          excludes=excludes):
-        try:
-            fin = open(path, "rb")
-        except EnvironmentError:
-            _, ex, _ = sys.exc_info()
-            if ex.errno in (errno.ENOENT, errno.EISDIR) and islink(path):
-                log.debug("skipped `%s': symlink" % path)
-                continue
-            raise
-        try:
-            content = fin.read()
-        finally:
-            fin.close()
-        if _BYTES_NULL in content:
-            log.debug("skipped `%s': binary file (null in content)" % path)
-            continue
-        eol, suggested_eol = eol_info_from_text(content)
-        yield path, eol, suggested_eol
+    if cache is not None:
+        cache = _ScanCache(cache)
+    paths = _paths_from_path_patterns(path_patterns,
+                                      recursive=recursive,
+                                      includes=includes,
+                                      excludes=excludes,
+                                      walk_threads=walk_threads,
+                                      ordered=ordered,
+                                      skip_vcs_dirs=skip_vcs_dirs,
+                                      respect_gitignore=respect_gitignore,
+                                      git_index=git_index,
+                                      skip_dupe_dirs=skip_dupes,
+                                      skip_dupe_files=skip_dupes,
+                                      min_size=min_size,
+                                      max_size=max_size,
+                                      with_stat=True,
+                                      cache=cache)
+    if shard is not None:
+        paths = _shard_path_stats(paths, shard)
+    return _eol_info_from_path_stats(paths, final_eol=final_eol,
+                                     inode_order=inode_order, cache=cache,
+                                     jobs=jobs, pool=pool,
+                                     read_ahead=read_ahead,
+                                     device_jobs=device_jobs,
+                                     mmap_size=mmap_size,
+                                     stream_size=stream_size)
+
+def eol_info_from_paths(paths, final_eol=False, shard=None):
+    """Generate EOL info for the given file paths.
+
+    Unlike eol_info_from_path_patterns(), "paths" (any iterable) are used
+    as is: they are not glob-expanded or checked for existence up front,
+    so they can be streamed from elsewhere (e.g. `eol --files-from -`).
+    Binary files are skipped, a file that doesn't exist is logged as an
+    error and skipped, and a path that isn't a regular file (e.g. a dir)
+    is logged and skipped. See eol_info_from_path_patterns() for what is
+    yielded.
+
+    "shard", if given, is an (I, N) 2-tuple: only the files in shard I
+    (1-based) of N are scanned. Here the shards are balanced by file size
+    (see _shard_path_stats()), which means that all "paths" are read and
+    `stat()`ed up front.
+    """
+    path_stats = _listed_path_stats(paths)
+    if shard is not None:
+        path_stats = _shard_path_stats(path_stats, shard, balance=True)
+    return _eol_info_from_path_stats(path_stats, final_eol=final_eol)
 
 
 def convert_text_eol(text, eol):
@@ -278,43 +533,153 @@ def convert_text_eol(text, eol):
     return re.sub(b'\r\n|\r|\n', bytes(eol, 'utf-8'), text)
 
 
-def convert_path_eol(path, eol, skip_binary_content=True, log=log):
+def convert_path_eol(path, eol, skip_binary_content=True, log=log,
+                     stream_size=256 * 1024 * 1024):
     """convert_path_eol(PATH, EOL)
 
     Convert the given file (in-place) to the given EOL. If no
     changes are necessary the file is not touched.
+
+    A file of "stream_size" bytes or more is converted a chunk at a time
+    rather than read whole (where it can be replaced via a temp file).
     """
-    fin = open(path, "rb")
-    try:
-        original = fin.read()
-    finally:
-        fin.close()
+    if os.stat(path).st_size >= stream_size \
+       and _convert_path_eol_streamed(path, eol, skip_binary_content, log):
+        return
+    original = _read_path(path)
     if skip_binary_content and _BYTES_NULL in original:
         log.debug("skipped `%s': binary file (null in content)" % path)
         return
     converted = convert_text_eol(original, eol)
     if original != converted:
         log.info("converted `%s' to %s EOLs", path, name_from_eol(eol))
-        fout = open(path, "wb")
-        try:
-            fout.write(converted)
-        finally:
-            fout.close()
+        _write_path(path, converted)
+    else:
+        log.debug("skipped `%s': no change required", path)
+
+
+def fix_path_final_eol(path, eol=None, skip_binary_content=True, log=log):
+    """fix_path_final_eol(PATH[, EOL])
+
+    Fix the given file (in-place) to end with exactly one EOL. See
+    fix_text_final_eol() for details. If no changes are necessary the
+    file is not touched.
+    """
+    original = _read_path(path)
+    if skip_binary_content and _BYTES_NULL in original:
+        log.debug("skipped `%s': binary file (null in content)" % path)
+        return
+    fixed = fix_text_final_eol(original, eol)
+    if original != fixed:
+        log.info("fixed final EOL in `%s'", path)
+        _write_path(path, fixed)
     else:
         log.debug("skipped `%s': no change required", path)
 
 
 def convert_path_patterns_eol(path_patterns, eol, recursive=False,
-                              excludes=[]):
+                              excludes=[], walk_threads=0, ordered=True,
+                              skip_vcs_dirs=False, respect_gitignore=False,
+                              git_index=False, skip_dupes=False,
+                              min_size=None, max_size=None, jobs=1,
+                              max_inflight=512 * 1024 * 1024,
+                              device_jobs=None, stream_size=256 * 1024 * 1024):
     """Convert the given paths (in-place) to the given EOL.  If no
     changes are necessary the file is not touched.
+
+    "jobs" is the number of files to convert at a time (default 1; 0 or
+    None for one per available CPU). Files are only started while the
+    memory needed for those in progress (about three times their size)
+    is at most "max_inflight" bytes. Each file is replaced atomically.
+    "device_jobs" is as for eol_info_from_path_patterns(), and
+    "stream_size" as for convert_path_eol().
+
+    Files that can't be converted (e.g. for lack of permissions) are
+    logged as errors and skipped. Returns a list of (PATH, ERROR)
+    2-tuples for them, ERROR being the `EnvironmentError`.
+
+    See eol_info_from_path_patterns() for the other arguments.
+    """
+    assert not isinstance(path_patterns, _BASESTRING), \
+        "'path_patterns' must be a sequence, not a string: %r" % path_patterns
+    paths = _paths_from_path_patterns(path_patterns,
+                                      recursive=recursive,
+                                      excludes=excludes,
+                                      walk_threads=walk_threads,
+                                      ordered=ordered,
+                                      skip_vcs_dirs=skip_vcs_dirs,
+                                      respect_gitignore=respect_gitignore,
+                                      git_index=git_index,
+                                      skip_dupe_dirs=skip_dupes,
+                                      skip_dupe_files=skip_dupes,
+                                      min_size=min_size,
+                                      max_size=max_size,
+                                      with_stat=True)
+    return _convert_path_stats_eol(paths, eol, jobs=jobs,
+                                   max_inflight=max_inflight,
+                                   device_jobs=device_jobs,
+                                   stream_size=stream_size)
+
+def convert_paths_eol(paths, eol, jobs=1, max_inflight=512 * 1024 * 1024,
+                      device_jobs=None, stream_size=256 * 1024 * 1024):
+    """Convert the given file paths (in-place) to the given EOL.
+
+    As with eol_info_from_paths(), "paths" are used as is. See
+    convert_path_patterns_eol() for the rest.
+    """
+    return _convert_path_stats_eol(_listed_path_stats(paths), eol,
+                                   jobs=jobs, max_inflight=max_inflight,
+                                   device_jobs=device_jobs,
+                                   stream_size=stream_size)
+
+def eol_info_from_path_patterns_async(path_patterns, executor=None,
+                                      **kwargs):
+    """An async iterator of eol_info_from_path_patterns() results, for
+    asyncio code:
+
+        async with eol_info_from_path_patterns_async(["src"],
+                recursive=True, jobs=8) as infos:
+            async for path, eol, suggested_eol in infos:
+                ...
+
+    The (blocking) walk and reads are run in "executor" (by default a
+    thread of its own), so they don't block the event loop. The keyword
+    arguments are as for eol_info_from_path_patterns(): e.g. "jobs" is
+    the number of files read at a time.
+
+    Closing it (on leaving the `async with` block, e.g. because the task
+    was cancelled, or with `await infos.aclose()`) stops the scan.
     """
     assert not isinstance(path_patterns, _BASESTRING), \
         "'path_patterns' must be a sequence, not a string: %r" % path_patterns
-    for path in _paths_from_path_patterns(path_patterns,
-                                          recursive=recursive,
-                                          excludes=excludes):
-        convert_path_eol(path, eol)
+    return _AsyncIterator(
+        lambda: eol_info_from_path_patterns(path_patterns, **kwargs),
+        executor=executor)
+
+def convert_paths_eol_async(paths, eol, jobs=1,
+                            max_inflight=512 * 1024 * 1024, executor=None,
+                            device_jobs=None, stream_size=256 * 1024 * 1024):
+    """Return an awaitable for convert_paths_eol(), for asyncio code:
+
+        failures = await convert_paths_eol_async(paths, LF, jobs=8)
+
+    The conversion is run in "executor" (by default the event loop's
+    default executor). If the awaiting task is cancelled, files not yet
+    started are left alone; those in progress are still converted (each
+    file is replaced atomically).
+    """
+    import asyncio
+    import threading
+    loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)()
+    stopped = threading.Event()
+    path_stats = _listed_path_stats(_until_set(stopped, paths))
+    future = loop.run_in_executor(executor,
+        lambda: _convert_path_stats_eol(path_stats, eol, jobs=jobs,
+                                        max_inflight=max_inflight,
+                                        device_jobs=device_jobs,
+                                        stream_size=stream_size))
+    future.add_done_callback(lambda f: stopped.set())
+    return future
 
 
 def mixed_eol_lines_in_text(text, eol=None):
@@ -362,174 +727,2878 @@ def mixed_eol_lines_in_text(text, eol=None):
     mixed_eol_lines.sort()
     return mixed_eol_lines
 
+def mixed_eol_lines_in_path(path, eol=None, jobs=1,
+                            chunk_size=64 * 1024 * 1024):
+    """mixed_eol_lines_in_path(PATH[, EOL]) -> LINE-NUMBERS...
+
+    Return a list of line numbers (0-based) of the given file with an EOL
+    that does not match the expected EOL. See mixed_eol_lines_in_text().
+
+    As with eol_info_from_path(), if "jobs" isn't 1 a big file is split
+    into byte ranges that are processed by a pool of "jobs" processes.
+    """
+    size = os.stat(path).st_size
+    if jobs == 1 or size < 2 * chunk_size:
+        jobs, chunk_size = 1, max(size, 1)
+    if eol is None:
+        counts = [0, 0, 0]
+        for range_counts in _map_path_ranges(_eol_counts_from_path_range,
+                path, size, jobs, chunk_size):
+            counts = [c + rc for c, rc in zip(counts, range_counts)]
+        eol = _eol_info_from_counts(*counts)[1]
+    elif eol not in (LF, CR, CRLF):
+        raise ValueError("illegal 'eol' value: %r" % eol)
+    mixed_eol_lines = []
+    num_lines = 0
+    for range_num_lines, range_lines in _map_path_ranges(
+            _mixed_eol_lines_from_path_range, path, size, jobs, chunk_size,
+            eol):
+        mixed_eol_lines += [num_lines + i for i in range_lines]
+        num_lines += range_num_lines
+    return mixed_eol_lines
+
 
 
 #---- internal support stuff
 
-## {{{ http://code.activestate.com/recipes/577230/ (r4)
-def _should_include_path(path, includes, excludes):
-    """Return True iff the given path should be included."""
-    from os.path import basename
-    from fnmatch import fnmatch
-
-    base = basename(path)
-    if includes:
-        for include in includes:
-            if fnmatch(base, include):
-                try:
-                    log.debug("include `%s' (matches `%s')", path, include)
-                except (NameError, AttributeError):
-                    pass
-                break
-        else:
-            try:
-                log.debug("exclude `%s' (matches no includes)", path)
-            except (NameError, AttributeError):
-                pass
-            return False
-    for exclude in excludes:
-        if fnmatch(base, exclude):
-            try:
-                log.debug("exclude `%s' (matches `%s')", path, exclude)
-            except (NameError, AttributeError):
-                pass
-            return False
-    return True
+def _eol_chars_from_text(text):
+    """Return the (CR, LF, CRLF) strings of the same type as `text`."""
+    if sys.version_info[0] > 2 and type(text) == bytes:
+        return (bytes([13]), bytes([10]), bytes([13, 10]))
+    return (CR, LF, CRLF)
 
-def _walk(top, topdown=True, onerror=None, follow_symlinks=False):
-    """A version of `os.walk()` with a couple differences regarding symlinks.
+def _eol_info_from_counts(numCRLFs, numCRs, numLFs):
+    """Return (EOL, SUGGESTED-EOL) given the number of each EOL."""
+    if numCRLFs == numLFs == numCRs == 0:
+        return (None, NATIVE)
 
-    1. follow_symlinks=False (the default): A symlink to a dir is
-       returned as a *non*-dir. In `os.walk()`, a symlink to a dir is
-       returned in the *dirs* list, but it is not recursed into.
-    2. follow_symlinks=True: A symlink to a dir is returned in the
-       *dirs* list (as with `os.walk()`) but it *is conditionally*
-       recursed into (unlike `os.walk()`).
+    # One a tie, prefer the native EOL.
+    eols = [(numCRLFs, CRLF == NATIVE, CRLF),
+            (numCRs,   CR   == NATIVE, CR),
+            (numLFs,   LF   == NATIVE, LF)]
+    eols.sort()
+
+    if eols[0][0] or eols[1][0]:
+        return (MIXED, eols[-1][-1])
+    else:
+        return (eols[-1][-1], eols[-1][-1])
 
-       A symlinked dir is only recursed into if it is to a deeper dir
-       within the same tree. This is my understanding of how `find -L
-       DIR` works.
+_numpy = None
+# NumPy only beats `bytes.count()` for batches of at least this many texts
+# of at most this mean size (in bytes).
+_NUMPY_MIN_TEXTS = 256
+_NUMPY_MAX_MEAN_SIZE = 128
+
+def _eol_counts_from_texts_numpy(texts):
+    """Return [(NUM-CRLFS, NUM-CRS, NUM-LFS), ...] for the given bytes
+    texts, or None if NumPy isn't available.
     """
-    import os
-    from os.path import join, isdir, islink, abspath
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    np = _numpy
+    if not np:
+        return None
 
-    # We may not have read permission for top, in which case we can't
-    # get a list of the files the directory contains.  os.path.walk
-    # always suppressed the exception then, rather than blow up for a
-    # minor reason when (say) a thousand readable directories are still
-    # left to visit.  That logic is copied here.
+    num_texts = len(texts)
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.intp,
+                          count=num_texts)
+    data = np.frombuffer(bytes().join(texts), dtype=np.uint8)
+    numCRLFs = np.zeros(num_texts, dtype=np.intp)
+    numCRs = np.zeros(num_texts, dtype=np.intp)
+    numLFs = np.zeros(num_texts, dtype=np.intp)
+    if data.size:
+        is_cr = data == 13
+        is_lf = data == 10
+        is_crlf = np.zeros(data.size, dtype=bool)
+        np.logical_and(is_cr[:-1], is_lf[1:], out=is_crlf[:-1])
+        # A CR ending one text and a LF starting the next is not a CRLF.
+        nonempty = lengths > 0
+        ends = np.cumsum(lengths)[nonempty]
+        is_crlf[ends - 1] = False
+        # Only reduce over the non-empty texts: `reduceat` does not give
+        # zero for an empty segment.
+        starts = ends - lengths[nonempty]
+        numCRLFs[nonempty] = np.add.reduceat(is_crlf, starts, dtype=np.intp)
+        numCRs[nonempty] = np.add.reduceat(is_cr, starts, dtype=np.intp)
+        numLFs[nonempty] = np.add.reduceat(is_lf, starts, dtype=np.intp)
+        numCRs -= numCRLFs
+        numLFs -= numCRLFs
+    return list(zip(numCRLFs.tolist(), numCRs.tolist(), numLFs.tolist()))
+
+def _path_ranges(path, size, chunk_size):
+    """Return (START, END) byte ranges of about "chunk_size" covering the
+    first "size" bytes of the given file.
+
+    A range never ends between the CR and LF of a CRLF, so that the EOLs
+    of each range can be counted separately and summed.
+    """
+    ranges = []
+    start = 0
+    fin = open(path, "rb")
     try:
-        names = os.listdir(top)
-    except OSError:
-        _, err, _ = sys.exc_info()
-        if onerror is not None:
-            onerror(err)
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                fin.seek(end - 1)
+                if fin.read(2) == _BYTES_CRLF:
+                    end += 1
+            ranges.append((start, end))
+            start = end
+    finally:
+        fin.close()
+    return ranges
+
+def _map_path_ranges(func, path, size, jobs, chunk_size, *args):
+    """Generate `func(PATH, START, END, *ARGS)` for the byte ranges of the
+    given file (see _path_ranges()), in order, running them in a pool of
+    "jobs" processes (0 or None for `_cpu_count()`) if there is more than
+    one.
+    """
+    ranges = _path_ranges(path, size, chunk_size)
+    if len(ranges) < 2 or jobs == 1:
+        for start, end in ranges:
+            yield func(path, start, end, *args)
         return
 
-    dirs, nondirs = [], []
-    if follow_symlinks:
-        for name in names:
-            if isdir(join(top, name)):
-                dirs.append(name)
+    from concurrent.futures import ProcessPoolExecutor
+    if not jobs:
+        jobs = _cpu_count()
+    executor = ProcessPoolExecutor(max_workers=min(jobs, len(ranges)))
+    futures = []
+    try:
+        futures = [executor.submit(func, path, start, end, *args)
+                   for start, end in ranges]
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def _read_path_range(path, start, end):
+    """Return the bytes in the given range of the given file, using mmap
+    where possible.
+    """
+    fin = open(path, "rb")
+    try:
+        try:
+            import mmap
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ImportError, ValueError, EnvironmentError):
+            fin.seek(start)
+            return fin.read(end - start)
+        try:
+            return mm[start:end]
+        finally:
+            mm.close()
+    finally:
+        fin.close()
+
+def _eol_counts_from_path_range(path, start, end):
+    """Return (NUM-CRLFS, NUM-CRS, NUM-LFS) for the given byte range of the
+    given file.
+    """
+    data = _read_path_range(path, start, end)
+    cr, lf, crlf = _eol_chars_from_text(data)
+    numCRLFs = data.count(crlf)
+    return (numCRLFs, data.count(cr) - numCRLFs, data.count(lf) - numCRLFs)
+
+def _mixed_eol_lines_from_path_range(path, start, end, eol):
+    """Return (NUM-LINES, MIXED-EOL-LINES) for the given byte range of the
+    given file: the number of EOLs in it and the (0-based, from the start
+    of the range) line numbers with an EOL other than "eol".
+    """
+    import re
+    data = _read_path_range(path, start, end)
+    cr, lf, crlf = _eol_chars_from_text(data)
+    eol = {CR: cr, LF: lf, CRLF: crlf}[eol]
+    mixed_eol_lines = []
+    num_lines = 0
+    for match in re.finditer(b"\r\n|\r|\n", data):
+        if match.group() != eol:
+            mixed_eol_lines.append(num_lines)
+        num_lines += 1
+    return num_lines, mixed_eol_lines
+
+def _eol_info_from_path_stats(path_stats, final_eol=False,
+                              inode_order=False, stats=None, cache=None,
+                              jobs=1, pool="thread", read_ahead=0,
+                              device_jobs=None, mmap_size=16 * 1024 * 1024,
+                              stream_size=256 * 1024 * 1024):
+    """Generate EOL info for the given (PATH, STAT) 2-tuples, as from
+    `_paths_from_path_patterns(..., with_stat=True)`.
+
+    STAT, if not None, is used to give the result for an empty regular
+    file without opening it. "cache", if given, is a `_ScanCache`: files
+    with an up-to-date result in it aren't read. It is closed when done.
+    If "jobs" isn't 1 (or "device_jobs" is given), files are scanned in
+    parallel: see _scan_path_stats_parallel(). See _read_path_stats() for
+    "inode_order", "read_ahead" and "stats", `_IOStrategy` for
+    "mmap_size" and "stream_size", and eol_info_from_paths() for the
+    rest.
+    """
+    from os.path import islink
+    full = final_eol or cache is not None
+    io = _IOStrategy(_BufferPool(), mmap_size=mmap_size,
+                     stream_size=stream_size)
+    if stats is not None:
+        stats.buffers = io.buffers
+    try:
+        if jobs == 1 and not device_jobs:
+            results = _scan_path_stats(path_stats, full=full,
+                inode_order=inode_order, stats=stats, cache=cache,
+                read_ahead=read_ahead, io=io)
+        else:
+            results = _scan_path_stats_parallel(path_stats, full=full,
+                jobs=jobs, pool=pool, stats=stats, cache=cache,
+                device_jobs=device_jobs, io=io)
+        for path, st, info, ex, from_cache in results:
+            if ex is not None:
+                if ex.errno in (errno.ENOENT, errno.EISDIR) \
+                   and islink(path):
+                    log.debug("skipped `%s': symlink" % path)
+                    continue
+                elif ex.errno == errno.ENOENT:
+                    log.error("`%s': No such file or directory", path)
+                    continue
+                elif ex.errno == errno.EISDIR:
+                    log.warning("skipped `%s': not a regular file", path)
+                    continue
+                raise ex
+            if cache is not None and not from_cache:
+                cache.put(path, st, info)
+            if info == _BINARY:
+                log.debug("skipped `%s': binary file (null in content)"
+                          % path)
+                continue
+            if final_eol:
+                yield (path,) + info
+            else:
+                yield path, info[0], info[1]
+    finally:
+        if cache is not None:
+            cache.close()
+
+def _scan_path_stats(path_stats, full=False, inode_order=False, stats=None,
+                     cache=None, read_ahead=0, io=None):
+    """Generate (PATH, STAT, INFO, ERROR, FROM-CACHE) 5-tuples scanning
+    the files for the given (PATH, STAT) 2-tuples one at a time.
+
+    INFO is as from _eol_info_from_content(), or None if the file
+    couldn't be read, in which case ERROR is the `EnvironmentError`.
+    FROM-CACHE is true if INFO came from "cache". See _read_path_stats()
+    for the other arguments.
+    """
+    for path, st, content, ex, cached in _read_path_stats(path_stats,
+            inode_order=inode_order, stats=stats, cache=cache,
+            read_ahead=read_ahead, io=io):
+        if cached is not None:
+            yield path, st, cached, None, True
+        elif ex is not None:
+            yield path, st, None, ex, False
+        else:
+            try:
+                # A _StreamedContent is only read as it is scanned.
+                info = _eol_info_from_content(content, full)
+            except EnvironmentError:
+                _, ex, _ = sys.exc_info()
+                yield path, st, None, ex, False
             else:
-                nondirs.append(name)
+                yield path, st, info, None, False
+
+def _scan_path_stats_parallel(path_stats, full=False, jobs=None,
+                              pool="thread", stats=None, cache=None,
+                              batch_size=64, batch_bytes=1024 * 1024,
+                              device_jobs=None, io=None):
+    """Like _scan_path_stats(), but reading and scanning files in a pool
+    of "jobs" workers (default `_cpu_count()`).
+
+        "pool" is "thread" (the default) to overlap waiting on I/O, or
+            "process" to also spread the CPU work over multiple cores.
+        "batch_size" and "batch_bytes" are the most files and (known)
+            bytes to send to a worker in one task, so that small files
+            don't cost a task (and for processes, a round-trip) each.
+        "device_jobs" is as for eol_info_from_path_patterns(): see
+            `_DeviceExecutors`.
+        "io" is the `_IOStrategy` to read files with. (Process workers
+            use a `_BufferPool` of their own.)
+
+    Up to 4 tasks per worker are queued at a time. Results are generated
+    in the given order: a FIFO of submitted batches is the reorder
+    buffer. Cache lookups and the result for empty files are done before
+    submitting, in the calling thread.
+    """
+    import time
+    from collections import deque
+    if pool == "process":
+        from concurrent.futures import ProcessPoolExecutor as Executor
+    elif pool == "thread":
+        from concurrent.futures import ThreadPoolExecutor as Executor
     else:
-        for name in names:
-            path = join(top, name)
-            if islink(path):
-                nondirs.append(name)
-            elif isdir(path):
-                dirs.append(name)
+        raise ValueError("unknown pool: %r" % pool)
+    if not jobs:
+        jobs = _cpu_count()
+    if io is None:
+        io = _IOStrategy()
+    if pool == "process":
+        io = _IOStrategy(None, io.mmap_size, io.stream_size, io.chunk_size)
+    executor = _DeviceExecutors(Executor, jobs, device_jobs)
+    max_pending = 4 * executor.max_workers
+
+    def batches():
+        # (DEV, BATCH) with BATCH a list of [PATH, STAT, INFO, FROM-CACHE]
+        # items, INFO being None for files to scan. A batch is for a
+        # single device.
+        batch = []
+        batch_total = 0
+        batch_dev = None
+        for path, st in path_stats:
+            if st is None and (cache is not None or device_jobs):
+                st = _stat_or_none(path)
+            dev = st is not None and st.st_dev or None
+            if batch and dev != batch_dev:
+                yield batch_dev, batch
+                batch = []
+                batch_total = 0
+            batch_dev = dev
+            cached = cache is not None and cache.get(path, st) or None
+            if cached is not None:
+                if stats is not None:
+                    stats.num_cache_hits += 1
+                batch.append([path, st, cached, True])
+            elif st is not None and st.st_size == 0 \
+                 and stat.S_ISREG(st.st_mode):
+                batch.append([path, st,
+                              _eol_info_from_content(_BYTES_EMPTY, full),
+                              False])
             else:
-                nondirs.append(name)
-
-    if topdown:
-        yield top, dirs, nondirs
-    for name in dirs:
-        path = join(top, name)
-        if follow_symlinks and islink(path):
-            # Only walk this path if it links deeper in the same tree.
-            top_abs = abspath(top)
-            link_abs = abspath(join(top, os.readlink(path)))
-            if not link_abs.startswith(top_abs + os.sep):
+                batch.append([path, st, None, False])
+                if st is not None:
+                    batch_total += st.st_size
+            if len(batch) >= batch_size or batch_total >= batch_bytes:
+                yield batch_dev, batch
+                batch = []
+                batch_total = 0
+        if batch:
+            yield batch_dev, batch
+
+    def results(batch, future):
+        scanned = future is not None and future.result() or []
+        i = 0
+        for path, st, info, from_cache in batch:
+            if info is not None:
+                yield path, st, info, None, from_cache
                 continue
-        for x in _walk(path, topdown, onerror, follow_symlinks=follow_symlinks):
-            yield x
-    if not topdown:
-        yield top, dirs, nondirs
+            info, ex, num_bytes = scanned[i]
+            i += 1
+            if stats is not None and ex is None:
+                stats.num_files_read += 1
+                stats.num_bytes_read += num_bytes
+            yield path, st, info, ex, False
 
-_NOT_SPECIFIED = ("NOT", "SPECIFIED")
-def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
-                              recursive=True, includes=None, excludes=None,
-                              skip_dupe_dirs=False,
-                              follow_symlinks=False,
-                              on_error=_NOT_SPECIFIED):
-    """_paths_from_path_patterns([<path-patterns>, ...]) -> file paths
+    pending = deque()
+    start = time.time()
+    try:
+        for dev, batch in batches():
+            paths = [item[0] for item in batch if item[2] is None]
+            future = paths \
+                     and executor.submit(dev, _scan_paths, paths, full, io) \
+                     or None
+            pending.append((batch, future))
+            while len(pending) >= max_pending:
+                for result in results(*pending.popleft()):
+                    yield result
+        while pending:
+            for result in results(*pending.popleft()):
+                yield result
+    finally:
+        for batch, future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=True)
+        if stats is not None:
+            stats.read_time += time.time() - start
 
-    Generate a list of paths (files and/or dirs) represented by the given path
-    patterns.
+class _DeviceExecutors(object):
+    """A pool of workers per device (`st_dev`), so that the number of
+    files processed at a time can be limited separately for each device.
 
-        "path_patterns" is a list of paths optionally using the '*', '?' and
-            '[seq]' glob patterns.
-        "files" is boolean (default True) indicating if file paths
-            should be yielded
-        "dirs" is string indicating under what conditions dirs are
-            yielded. It must be one of:
-              never             (default) never yield dirs
-              always            yield all dirs matching given patterns
-              if-not-recursive  only yield dirs for invocations when
-                                recursive=False
-            See use cases below for more details.
-        "recursive" is boolean (default True) indicating if paths should
-            be recursively yielded under given dirs.
-        "includes" is a list of file patterns to include in recursive
-            searches.
-        "excludes" is a list of file and dir patterns to exclude.
-            (Note: This is slightly different than GNU grep's --exclude
-            option which only excludes *files*.  I.e. you cannot exclude
-            a ".svn" dir.)
-        "skip_dupe_dirs" can be set True to watch for and skip
-            descending into a dir that has already been yielded. Note
-            that this currently does not dereference symlinks.
-        "follow_symlinks" is a boolean indicating whether to follow
-            symlinks (default False). To guard against infinite loops
-            with circular dir symlinks, only dir symlinks to *deeper*
-            dirs are followed.
-        "on_error" is an error callback called when a given path pattern
-            matches nothing:
-                on_error(PATH_PATTERN)
-            If not specified, the default is look for a "log" global and
-            call:
-                log.error("`%s': No such file or directory")
-            Specify None to do nothing.
+    "Executor" is the `concurrent.futures` executor class to use. A
+    device gets "jobs" workers unless "jobs_from_dev" maps it (a path on
+    it, or its `st_dev`) to another number. If "jobs_from_dev" is empty,
+    all devices share a single pool of "jobs" workers.
+    """
+    def __init__(self, Executor, jobs, jobs_from_dev=None):
+        self._Executor = Executor
+        self._jobs = jobs
+        self._jobs_from_dev = {}
+        for dev, dev_jobs in (jobs_from_dev or {}).items():
+            if isinstance(dev, _BASESTRING):
+                dev = os.stat(dev).st_dev
+            if dev_jobs < 1:
+                raise ValueError("invalid number of jobs for device %r: %r"
+                                 % (dev, dev_jobs))
+            self._jobs_from_dev[dev] = dev_jobs
+        self.max_workers = max([jobs] + list(self._jobs_from_dev.values()))
+        self._executor_from_dev = {}
 
-    Typically this is useful for a command-line tool that takes a list
-    of paths as arguments. (For Unix-heads: the shell on Windows does
-    NOT expand glob chars, that is left to the app.)
+    def submit(self, dev, func, *args):
+        """Submit `func(*ARGS)` to the pool for the given device."""
+        if not self._jobs_from_dev:
+            dev = None
+        executor = self._executor_from_dev.get(dev)
+        if executor is None:
+            executor = self._executor_from_dev[dev] = self._Executor(
+                max_workers=self._jobs_from_dev.get(dev, self._jobs))
+        return executor.submit(func, *args)
 
-    Use case #1: like `grep -r`
-      {files=True, dirs='never', recursive=(if '-r' in opts)}
-        script FILE     # yield FILE, else call on_error(FILE)
-        script DIR      # yield nothing
-        script PATH*    # yield all files matching PATH*; if none,
-                        # call on_error(PATH*) callback
-        script -r DIR   # yield files (not dirs) recursively under DIR
-        script -r PATH* # yield files matching PATH* and files recursively
-                        # under dirs matching PATH*; if none, call
-                        # on_error(PATH*) callback
+    def shutdown(self, wait=True):
+        for executor in self._executor_from_dev.values():
+            executor.shutdown(wait=wait)
 
-    Use case #2: like `file -r` (if it had a recursive option)
-      {files=True, dirs='if-not-recursive', recursive=(if '-r' in opts)}
-        script FILE     # yield FILE, else call on_error(FILE)
-        script DIR      # yield DIR, else call on_error(DIR)
-        script PATH*    # yield all files and dirs matching PATH*; if none,
-                        # call on_error(PATH*) callback
-        script -r DIR   # yield files (not dirs) recursively under DIR
-        script -r PATH* # yield files matching PATH* and files recursively
-                        # under dirs matching PATH*; if none, call
-                        # on_error(PATH*) callback
+def _device_jobs_from_strs(strs):
+    """Return a dict mapping device (`st_dev`) to number of jobs for the
+    given "PATH=N" strings, as for `eol --device-jobs`.
+    """
+    jobs_from_dev = {}
+    for s in strs:
+        path, sep, jobs = s.rpartition("=")
+        try:
+            if not sep or not path:
+                raise ValueError
+            jobs = int(jobs)
+            if jobs < 1:
+                raise ValueError
+        except ValueError:
+            raise ValueError("invalid device jobs (expected PATH=N): %r"
+                             % s)
+        try:
+            jobs_from_dev[os.stat(path).st_dev] = jobs
+        except OSError:
+            _, ex, _ = sys.exc_info()
+            raise ValueError("invalid device jobs: `%s': %s"
+                             % (path, ex.strerror or ex))
+    return jobs_from_dev
 
-    Use case #3: kind of like `find .`
+_worker_buffers = None
+
+def _scan_paths(paths, full=False, io=None):
+    """Return a list of (INFO, ERROR, NUM-BYTES) 3-tuples scanning the given
+    files: the task for a worker in _scan_path_stats_parallel().
+
+    Files are read with "io", an `_IOStrategy`. If it has no buffers (as
+    in a process worker), a `_BufferPool` for the process is used.
+    """
+    global _worker_buffers
+    if io is None:
+        io = _IOStrategy()
+    if io.buffers is None:
+        if _worker_buffers is None:
+            _worker_buffers = _BufferPool()
+        io = _IOStrategy(_worker_buffers, io.mmap_size, io.stream_size,
+                         io.chunk_size)
+    results = []
+    for path in paths:
+        try:
+            content = io.read_path(path)
+            # A _StreamedContent is only read as it is scanned.
+            info = _eol_info_from_content(content, full)
+        except EnvironmentError:
+            _, ex, _ = sys.exc_info()
+            results.append((None, ex, 0))
+            continue
+        results.append((info, None, len(content)))
+    return results
+
+def _eol_info_from_content(content, full=False):
+    """Return _BINARY for binary content, else (EOL, SUGGESTED-EOL) for
+    the given file content, plus (FINAL-EOL, NUM-TRAILING-BLANK-LINES) if
+    "full" is true.
+
+    "content" can also be a memoryview of the start of a bytearray, as
+    from `_BufferPool.read_path()`, which is scanned in place, or a
+    `_StreamedContent`.
+    """
+    if isinstance(content, _StreamedContent):
+        return content.count().info(full)
+    if isinstance(content, memoryview):
+        return _eol_info_from_buffer(content.obj, len(content), full)
+    if _BYTES_NULL in content:
+        return _BINARY
+    if full:
+        return eol_info_from_text(content) + final_eol_info_from_text(content)
+    return eol_info_from_text(content)
+
+def _eol_info_from_buffer(buf, end, full=False):
+    """Like _eol_info_from_content(), for the first "end" bytes of the
+    given bytearray, without copying them.
+    """
+    if buf.find(_BYTES_NULL, 0, end) != -1:
+        return _BINARY
+    cr, lf, crlf = _eol_chars_from_text(_BYTES_EMPTY)
+    numCRLFs = buf.count(crlf, 0, end)
+    info = _eol_info_from_counts(numCRLFs, buf.count(cr, 0, end) - numCRLFs,
+                                 buf.count(lf, 0, end) - numCRLFs)
+    if full:
+        # Only the trailing EOLs (and whether there is anything before
+        # them) matter for the final EOL info.
+        start = end
+        while start and buf[start-1] in (10, 13):
+            start -= 1
+        info += final_eol_info_from_text(bytes(buf[max(start-1, 0):end]))
+    return info
+
+def _cpu_count():
+    """Return the number of CPUs this process may use: those in its CPU
+    affinity mask, capped by any cgroup CPU quota (e.g. from
+    `docker run --cpus=2`), which `os.cpu_count()` ignores.
+    """
+    import math
+    try:
+        count = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        try:
+            count = os.cpu_count() or 1
+        except AttributeError:
+            import multiprocessing
+            count = multiprocessing.cpu_count()
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, max(1, int(math.ceil(quota))))
+    return count
+
+def _cgroup_cpu_quota():
+    """Return the CPU quota of this process's cgroup, in CPUs, or None if
+    there isn't one (or this isn't Linux).
+    """
+    # cgroup v2: "cpu.max" is "$MAX $PERIOD", in the cgroup's dir.
+    cgroup = "/"
+    try:
+        fin = open("/proc/self/cgroup")
+        try:
+            for line in fin:
+                if line.startswith("0::"):
+                    cgroup = line[3:].strip()
+        finally:
+            fin.close()
+    except EnvironmentError:
+        return None
+    for cpu_max_path in ("/sys/fs/cgroup%s/cpu.max" % cgroup.rstrip('/'),
+                         "/sys/fs/cgroup/cpu.max"):
+        try:
+            quota, period = _read_path(cpu_max_path).split()[:2]
+        except (EnvironmentError, ValueError):
+            continue
+        if quota == b"max":
+            return None
+        return int(quota) / float(period)
+    # cgroup v1
+    try:
+        quota = int(_read_path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"))
+        period = int(_read_path("/sys/fs/cgroup/cpu/cpu.cfs_period_us"))
+    except (EnvironmentError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / float(period)
+
+def _read_path_stats(path_stats, inode_order=False, batch_size=256,
+                     batch_bytes=32 * 1024 * 1024, stats=None, cache=None,
+                     read_ahead=0, io=None):
+    """Generate (PATH, STAT, CONTENT, ERROR, CACHED) 5-tuples reading the
+    files for the given (PATH, STAT) 2-tuples.
+
+    ERROR is the `EnvironmentError` if the file couldn't be opened (and
+    CONTENT is then None), else None. An empty regular file (going by
+    STAT) isn't opened. A file of `io.mmap_size` bytes or more is only
+    opened here: its CONTENT is a `_StreamedContent` that is read as it
+    is scanned, and so can still raise `EnvironmentError`. Neither
+    "inode_order" nor "read_ahead" reads such files ahead of time.
+
+    "cache", if given, is a `_ScanCache`. A file with an up-to-date
+    result in it isn't read: CACHED is the result (see
+    `_ScanCache.get()`) and CONTENT None. Otherwise CACHED is None. A
+    STAT of None is filled in for this.
+
+    If "inode_order" is true, files are read in batches of up to
+    "batch_size" files (or about "batch_bytes" bytes) in inode number
+    order, which on many filesystems is close to on-disk order and so
+    cuts seeking on a cold cache. Results are still generated in the
+    given order. A STAT of None is filled in for this.
+
+    Otherwise, if "read_ahead" isn't 0, that many threads read the next
+    files while the current one is being processed. See
+    _read_path_stats_ahead().
+
+    Files are read with "io", an `_IOStrategy` (by default one without
+    buffers). If it has buffers and files are read one at a time,
+    CONTENT may be a memoryview of a buffer that is reused for the next
+    file.
+
+    "stats", if given, is a `_ScanStats` to count reads in.
+    """
+    import time
+    if io is None:
+        io = _IOStrategy()
+    if read_ahead and not inode_order:
+        for item in _read_path_stats_ahead(path_stats, readers=read_ahead,
+                max_bytes=batch_bytes, stats=stats, cache=cache, io=io):
+            yield item
+        return
+    if not inode_order:
+        batch_size = 1
+    batch = []
+    batch_total = 0
+    path_stats = iter(path_stats)
+    while True:
+        for path, st in path_stats:
+            if st is None and (inode_order or cache is not None):
+                st = _stat_or_none(path)
+            cached = cache is not None and cache.get(path, st) or None
+            batch.append([path, st, None, None, cached])
+            if cached is not None:
+                if stats is not None:
+                    stats.num_cache_hits += 1
+            elif st is not None:
+                batch_total += st.st_size
+            if len(batch) >= batch_size or batch_total >= batch_bytes:
+                break
+        if not batch:
+            break
+        if inode_order:
+            order = sorted(batch, key=_ino_from_read_item)
+        else:
+            order = batch
+        start = time.time()
+        for item in order:
+            path, st = item[:2]
+            if item[4] is not None:
+                continue
+            if st is not None and st.st_size == 0 \
+               and stat.S_ISREG(st.st_mode):
+                item[2] = _BYTES_EMPTY
+                continue
+            try:
+                item[2] = io.read_path(path, reuse=not inode_order)
+            except EnvironmentError:
+                _, item[3], _ = sys.exc_info()
+                continue
+            if stats is not None:
+                stats.num_files_read += 1
+                stats.num_bytes_read += len(item[2])
+        if stats is not None:
+            stats.read_time += time.time() - start
+        for item in batch:
+            yield tuple(item)
+        batch = []
+        batch_total = 0
+
+def _read_path_stats_ahead(path_stats, readers=2, max_files=None,
+                           max_bytes=32 * 1024 * 1024, stats=None,
+                           cache=None, io=None):
+    """Like _read_path_stats(), but with "readers" threads reading files
+    ahead of the ones being generated.
+
+    Up to "max_files" files (default 4 per reader), of up to "max_bytes"
+    bytes in all (going by STAT), are read ahead. A bigger file is read
+    on its own. The "read_time" of "stats" is the time spent waiting for
+    reads to complete. Files are read with "io" (an `_IOStrategy`), but
+    not into its buffers.
+    """
+    import time
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    if max_files is None:
+        max_files = 4 * readers
+    if io is None:
+        io = _IOStrategy()
+    executor = ThreadPoolExecutor(max_workers=readers)
+    # [PATH, STAT, FUTURE-OR-CONTENT, ERROR, CACHED, SIZE] for each file,
+    # in order.
+    pending = deque()
+    pending_bytes = 0
+    path_stats = iter(path_stats)
+    try:
+        while True:
+            for path, st in path_stats:
+                if st is None and cache is not None:
+                    st = _stat_or_none(path)
+                cached = cache is not None and cache.get(path, st) or None
+                item = [path, st, None, None, cached, 0]
+                if cached is not None:
+                    if stats is not None:
+                        stats.num_cache_hits += 1
+                elif st is not None and st.st_size == 0 \
+                     and stat.S_ISREG(st.st_mode):
+                    item[2] = _BYTES_EMPTY
+                else:
+                    item[2] = executor.submit(io.read_path, path, False)
+                    item[5] = st is not None and st.st_size or 0
+                    pending_bytes += item[5]
+                pending.append(item)
+                if len(pending) >= max_files or pending_bytes >= max_bytes:
+                    break
+            if not pending:
+                break
+            item = pending.popleft()
+            pending_bytes -= item[5]
+            future = item[2]
+            if hasattr(future, "result"):
+                start = time.time()
+                try:
+                    item[2] = future.result()
+                except EnvironmentError:
+                    _, item[3], _ = sys.exc_info()
+                    item[2] = None
+                if stats is not None:
+                    stats.read_time += time.time() - start
+                    if item[3] is None:
+                        stats.num_files_read += 1
+                        stats.num_bytes_read += len(item[2])
+            yield tuple(item[:5])
+    finally:
+        for item in pending:
+            if hasattr(item[2], "cancel"):
+                item[2].cancel()
+        executor.shutdown(wait=True)
+
+def _ino_from_read_item(item):
+    st = item[1]
+    return st is not None and st.st_ino or 0
+
+class _ScanStats(object):
+    """Counters for a run, reported with `eol --stats`."""
+    def __init__(self):
+        import time
+        self.start_time = time.time()
+        self.num_files_read = 0
+        self.num_bytes_read = 0
+        self.num_cache_hits = 0
+        self.read_time = 0.0
+        # The `_BufferPool` files were read into, if any.
+        self.buffers = None
+
+    def report(self, log=log):
+        import time
+        elapsed = time.time() - self.start_time
+        log.info("stats: read %d file(s), %d bytes in %.3fs (%.1f MB/s), "
+                 "%d from cache, %.3fs total", self.num_files_read,
+                 self.num_bytes_read, self.read_time,
+                 self.num_bytes_read / 1048576.0
+                    / max(self.read_time, 1e-6),
+                 self.num_cache_hits, elapsed)
+        if self.buffers is not None:
+            log.info("stats: %d read buffer allocation(s) for %d read(s), "
+                     "%.1f MB peak buffer memory",
+                     self.buffers.num_allocs, self.buffers.num_reads,
+                     self.buffers.peak_bytes / 1048576.0)
+        peak_rss = _peak_rss()
+        if peak_rss is not None:
+            log.info("stats: %.1f MB peak memory (RSS)",
+                     peak_rss / 1048576.0)
+
+def _peak_rss():
+    """Return the peak resident memory of this process in bytes, or None
+    if unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024    # in KiB
+    return peak
+
+class _BufferPool(object):
+    """Reusable buffers to read files into: a growable bytearray per
+    thread, so that reading many files doesn't allocate a new bytes
+    object for each.
+
+    Files bigger than "max_size" are read as usual, so that one big
+    file doesn't leave a big buffer around. Counts reads, buffer
+    allocations and the peak total size of the buffers.
+    """
+    def __init__(self, max_size=16 * 1024 * 1024, min_size=64 * 1024):
+        import threading
+        self.max_size = max_size
+        self.min_size = min_size
+        self.num_reads = 0
+        self.num_allocs = 0
+        self.peak_bytes = 0
+        self._total_bytes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def read_path(self, path):
+        """Return the content of the given file: a memoryview of this
+        thread's buffer, valid until the next read_path() call in this
+        thread, or bytes for a big file.
+        """
+        fin = open(path, "rb")
+        try:
+            return self.read_file(fin, os.fstat(fin.fileno()).st_size)
+        finally:
+            fin.close()
+
+    def read_file(self, fin, size):
+        """Like read_path(), for the given open file of the given size."""
+        if size >= self.max_size:
+            with self._lock:
+                self.num_reads += 1
+            return fin.read()
+        # Room for one more byte, to tell if the file grew.
+        buf = self.buffer(size + 1)
+        end = 0
+        while True:
+            view = memoryview(buf)
+            try:
+                num_read = fin.readinto(view[end:])
+            finally:
+                view.release()
+            if not num_read:
+                break
+            end += num_read
+            if end == len(buf):
+                buf = self.buffer(2 * end, keep=end)
+        with self._lock:
+            self.num_reads += 1
+        return memoryview(buf)[:end]
+
+    def buffer(self, size, keep=0):
+        """Return this thread's buffer, replaced with a bigger one
+        (keeping its first "keep" bytes) if it isn't "size" bytes.
+        """
+        buf = getattr(self._local, "buf", None)
+        if buf is not None and len(buf) >= size:
+            return buf
+        new_size = self.min_size
+        while new_size < size:
+            new_size *= 2
+        new_buf = bytearray(new_size)
+        if keep:
+            new_buf[:keep] = buf[:keep]
+        self._local.buf = new_buf
+        with self._lock:
+            self.num_allocs += 1
+            self._total_bytes += new_size - (buf is not None and len(buf)
+                                             or 0)
+            self.peak_bytes = max(self.peak_bytes, self._total_bytes)
+        return new_buf
+
+class _IOStrategy(object):
+    """Picks how to read a file for scanning, by its size and filesystem:
+
+        "read"      read it whole into a new bytes object
+        "readinto"  read it whole into a reused buffer (see `_BufferPool`)
+        "mmap"      map it and scan it a window at a time
+        "chunked"   read and scan it a chunk at a time
+
+    Files under "mmap_size" bytes are read whole: into "buffers", if
+    given and the file fits (see `_BufferPool.max_size`). Bigger ones are
+    mapped, except those of "stream_size" bytes or more and those on a
+    network filesystem (where a mapping can fault if the file shrinks),
+    which are read in "chunk_size" chunks. Big files are read with a
+    sequential access hint (`posix_fadvise()`), where supported.
+    """
+    # Files from this size get a sequential access hint when read whole.
+    ADVISE_SIZE = 1024 * 1024
+    NETWORK_FS_TYPES = frozenset(["nfs", "nfs4", "cifs", "smb3", "smbfs",
+        "ncpfs", "afs", "9p", "ceph", "glusterfs", "lustre", "gpfs",
+        "fuse.sshfs", "fuse.glusterfs", "fuse.s3fs"])
+
+    def __init__(self, buffers=None, mmap_size=16 * 1024 * 1024,
+                 stream_size=256 * 1024 * 1024, chunk_size=8 * 1024 * 1024):
+        self.buffers = buffers
+        self.mmap_size = mmap_size
+        self.stream_size = stream_size
+        self.chunk_size = chunk_size
+
+    def strategy(self, st, reuse=True):
+        """Return the name of the strategy for a file with the given
+        `stat()` info. If "reuse" is false the buffers aren't used.
+        """
+        size = st.st_size
+        if size >= self.stream_size or (size >= self.mmap_size
+                and _fs_type(st.st_dev) in self.NETWORK_FS_TYPES):
+            return "chunked"
+        elif size >= self.mmap_size:
+            return "mmap"
+        elif reuse and self.buffers is not None \
+             and size < self.buffers.max_size:
+            return "readinto"
+        return "read"
+
+    def read_path(self, path, reuse=True):
+        """Return the content of the given file for
+        _eol_info_from_content(): bytes, a memoryview of a reused buffer
+        (for "readinto", valid until the next read in this thread) or a
+        `_StreamedContent` (for "mmap" and "chunked").
+        """
+        fin = open(path, "rb")
+        try:
+            st = os.fstat(fin.fileno())
+            strategy = self.strategy(st, reuse)
+            if strategy in ("mmap", "chunked"):
+                return _StreamedContent(path, st.st_size,
+                    use_mmap=(strategy == "mmap"),
+                    chunk_size=self.chunk_size,
+                    buffers=reuse and self.buffers or None)
+            if st.st_size >= self.ADVISE_SIZE:
+                _advise_sequential(fin.fileno())
+            if strategy == "readinto":
+                return self.buffers.read_file(fin, st.st_size)
+            return fin.read()
+        finally:
+            fin.close()
+
+class _StreamedContent(object):
+    """The content of a (big) file that is scanned a chunk at a time,
+    from a mapping of the file if "use_mmap", rather than read whole.
+    See `_IOStrategy`.
+    """
+    def __init__(self, path, size, use_mmap=False,
+                 chunk_size=8 * 1024 * 1024, buffers=None):
+        self.path = path
+        self.size = size
+        self.use_mmap = use_mmap
+        self.chunk_size = chunk_size
+        self.buffers = buffers
+
+    def __len__(self):
+        return self.size
+
+    def count(self):
+        """Return an `_EolCounter` for the content, stopping early if it
+        is binary.
+        """
+        counter = _EolCounter()
+        for buf, end in self.chunks():
+            counter.feed(buf, end)
+            if counter.binary:
+                break
+        return counter
+
+    def chunks(self):
+        """Generate (BUF, END) for each chunk of the content: its first END
+        bytes of BUF, which may be reused for the next chunk.
+        """
+        fin = open(self.path, "rb")
+        try:
+            mm = None
+            if self.use_mmap:
+                try:
+                    import mmap
+                    mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ImportError, ValueError, EnvironmentError):
+                    pass
+            if mm is not None:
+                try:
+                    if hasattr(mm, "madvise"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    for start in range(0, len(mm), self.chunk_size):
+                        window = mm[start:start + self.chunk_size]
+                        yield window, len(window)
+                finally:
+                    mm.close()
+                return
+            _advise_sequential(fin.fileno())
+            if self.buffers is not None:
+                buf = self.buffers.buffer(self.chunk_size)
+            else:
+                buf = bytearray(self.chunk_size)
+            view = memoryview(buf)[:self.chunk_size]
+            try:
+                while True:
+                    num_read = fin.readinto(view)
+                    if not num_read:
+                        break
+                    yield buf, num_read
+            finally:
+                view.release()
+        finally:
+            fin.close()
+
+class _EolCounter(object):
+    """Counts the EOLs of content fed to it a chunk at a time (see
+    feed()), for _eol_info_from_content() results.
+
+    A CRLF split between two chunks is counted as a CRLF. The trailing
+    run of EOL chars is counted separately for the final EOL info.
+    """
+    def __init__(self):
+        # CRs and LFs, including those in CRLFs, as from `bytes.count()`.
+        self.num_crlfs = self.num_crs = self.num_lfs = 0
+        self.binary = False
+        # The last two bytes so far.
+        self._last = _BYTES_EMPTY
+        # The (CRLFS, CRS, LFS) counts of the trailing run of EOL chars, and
+        # whether there is anything before it.
+        self._run = (0, 0, 0)
+        self._run_after_content = False
+
+    def feed(self, buf, end):
+        """Count the first "end" bytes of the given bytes or bytearray."""
+        if not end:
+            return
+        cr, lf, crlf = _eol_chars_from_text(_BYTES_EMPTY)
+        if buf.find(_BYTES_NULL, 0, end) != -1:
+            self.binary = True
+        split_crlf = self._last[-1:] == cr and buf[0:1] == lf and 1 or 0
+        self.num_crlfs += buf.count(crlf, 0, end) + split_crlf
+        self.num_crs += buf.count(cr, 0, end)
+        self.num_lfs += buf.count(lf, 0, end)
+
+        start = end
+        while start and buf[start-1] in (10, 13):
+            start -= 1
+        run = bytes(buf[start:end])
+        run = (run.count(crlf), run.count(cr), run.count(lf))
+        if start:
+            self._run = run
+            self._run_after_content = True
+        else:
+            self._run = (self._run[0] + run[0] + split_crlf,
+                         self._run[1] + run[1], self._run[2] + run[2])
+        self._last = (self._last + bytes(buf[max(end-2, 0):end]))[-2:]
+
+    def info(self, full=False):
+        """Return the _eol_info_from_content() result for the content fed
+        so far.
+        """
+        if self.binary:
+            return _BINARY
+        info = _eol_info_from_counts(self.num_crlfs,
+                                     self.num_crs - self.num_crlfs,
+                                     self.num_lfs - self.num_crlfs)
+        if not full:
+            return info
+        cr, lf, crlf = _eol_chars_from_text(_BYTES_EMPTY)
+        num_crlfs, num_crs, num_lfs = self._run
+        num_eols = num_crs + num_lfs - num_crlfs
+        if not num_eols:
+            return info + (None, 0)
+        if self._last.endswith(crlf):
+            final_eol = CRLF
+        elif self._last.endswith(lf):
+            final_eol = LF
+        else:
+            final_eol = CR
+        if self._run_after_content:
+            # The first EOL in the run terminates the last line of content.
+            num_eols -= 1
+        return info + (final_eol, num_eols)
+
+def _advise_sequential(fd):
+    """Tell the kernel that the given file will be read sequentially, if
+    the platform allows.
+    """
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+_fs_type_from_dev = None
+
+def _fs_type(dev):
+    """Return the type of the filesystem (e.g. "ext4" or "nfs4") on the
+    given device (`st_dev`), from "/proc/self/mountinfo", or None if
+    unknown.
+    """
+    global _fs_type_from_dev
+    if _fs_type_from_dev is None:
+        fs_type_from_dev = {}
+        try:
+            lines = _read_path("/proc/self/mountinfo").decode(
+                "utf-8", "replace").splitlines()
+        except EnvironmentError:
+            lines = []
+        for line in lines:
+            # E.g. "36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 ..."
+            fields = line.split()
+            try:
+                major, minor = fields[2].split(":")
+                fs_type = fields[fields.index("-") + 1]
+                dev_key = os.makedev(int(major), int(minor))
+            except (ValueError, IndexError, AttributeError):
+                continue
+            fs_type_from_dev.setdefault(dev_key, fs_type)
+        _fs_type_from_dev = fs_type_from_dev
+    return _fs_type_from_dev.get(dev)
+
+# The scan result for a binary file.
+_BINARY = ("BINARY",)
+
+class _ScanCache(object):
+    """A persistent cache of scan results and filtered dir listings, in an
+    SQLite database. It can be used from multiple threads.
+
+    Results are keyed by absolute path and only used while the file's
+    stat signature `(st_size, st_mtime_ns, st_ino, st_ctime_ns)` is
+    unchanged, so a warm run only needs the `stat()` info the dir walk
+    gets anyway. Any write or `touch` changes the mtime or ctime, and
+    replacing a file (e.g. a `git checkout`) changes the inode.
+
+    Results aren't stored for files changed within `RACY_NS` of the start
+    of the run: another change within the filesystem's timestamp
+    granularity might not change the signature (as with git's "racily
+    clean" index entries). The whole cache is dropped if it was written
+    by another version of eol, or if its tables can't be set up. Rows for
+    deleted files are never used, just left behind.
+
+    An existing file that isn't an eol scan cache is never touched:
+    `Error` is raised instead.
+
+    Dir listings (see get_dir()) are validated the same way, by the
+    dir's stat signature: adding, removing or renaming an entry changes
+    the dir's mtime. Names are stored '/'-separated, as no file name can
+    contain a '/'.
+    """
+    FORMAT = 1
+    RACY_NS = 2 * 1000000000
+    COMMIT_EVERY = 1000
+
+    _name_from_eol = {CRLF: "CRLF", CR: "CR", LF: "LF", MIXED: "MIXED"}
+
+    def __init__(self, path):
+        import sqlite3
+        import time
+        import threading
+        self.path = path
+        self.start_ns = int(time.time() * 1e9)
+        self._num_puts = 0
+        self._lock = threading.Lock()
+        self._conn = self._connect(path)
+        try:
+            self._setup()
+        except sqlite3.DatabaseError:
+            # An eol scan cache, but with a broken schema: start over.
+            _, ex, _ = sys.exc_info()
+            log.warning("recreating scan cache `%s': %s", path, ex)
+            self._conn.close()
+            os.remove(path)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._setup()
+
+    def _connect(self, path):
+        """Return a connection to the cache at the given path, raising
+        `Error` if there is a file there that isn't an eol scan cache.
+        """
+        import sqlite3
+        if not os.path.exists(path):
+            return sqlite3.connect(path, check_same_thread=False)
+        error = Error("`%s' is not an eol scan cache" % path)
+        f = open(path, "rb")
+        try:
+            header = f.read(16)
+        finally:
+            f.close()
+        if header != "SQLite format 3\0".encode("ascii"):
+            raise error
+        conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        if row is None:
+            conn.close()
+            raise error
+        return conn
+
+    def _setup(self):
+        conn = self._conn
+        conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                     "(key TEXT PRIMARY KEY, value TEXT)")
+        version = "%d %s" % (self.FORMAT, __version__)
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            conn.execute("DROP TABLE IF EXISTS results")
+            conn.execute("DROP TABLE IF EXISTS dirs")
+            conn.execute("INSERT OR REPLACE INTO meta VALUES "
+                         "('version', ?)", (version,))
+        conn.execute("CREATE TABLE IF NOT EXISTS results "
+                     "(path TEXT PRIMARY KEY, signature TEXT, "
+                     "eol TEXT, suggested_eol TEXT, final_eol TEXT, "
+                     "num_trailing INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS dirs "
+                     "(path TEXT PRIMARY KEY, signature TEXT, "
+                     "filter_key TEXT, dirnames TEXT, filenames TEXT)")
+        conn.commit()
+
+    def get(self, path, st):
+        """Return the cached result for the given path, or None if there
+        isn't an up-to-date one: _BINARY for a binary file, else
+        (EOL, SUGGESTED-EOL, FINAL-EOL, NUM-TRAILING-BLANK-LINES).
+        """
+        if st is None:
+            return None
+        row = self._select("SELECT signature, eol, suggested_eol, "
+            "final_eol, num_trailing FROM results WHERE path = ?", path)
+        if row is None or row[0] != _stat_signature(st):
+            return None
+        if row[1] == "BINARY":
+            return _BINARY
+        return (_eol_from_name.get(row[1]), _eol_from_name.get(row[2]),
+                _eol_from_name.get(row[3]), row[4])
+
+    def put(self, path, st, info):
+        """Store the result for the given path (a 4-tuple as returned by
+        get(), or _BINARY), if it can be trusted.
+        """
+        if st is None or len(info) < 4 and info != _BINARY:
+            return
+        if info == _BINARY:
+            row = ("BINARY", None, None, None)
+        else:
+            name = self._name_from_eol.get
+            row = (name(info[0]), name(info[1]), name(info[2]), info[3])
+        self._insert("results", path, st, row)
+
+    def get_dir(self, path, st, filter_key):
+        """Return the cached (DIRNAMES, FILENAMES) listing of the given
+        dir, as filtered with "filter_key", or None if there isn't an
+        up-to-date one.
+        """
+        row = self._select("SELECT signature, filter_key, dirnames, "
+                           "filenames FROM dirs WHERE path = ?", path)
+        if row is None or row[0] != _stat_signature(st) \
+           or row[1] != filter_key:
+            return None
+        return (row[2] and row[2].split('/') or [],
+                row[3] and row[3].split('/') or [])
+
+    def put_dir(self, path, st, filter_key, dirnames, filenames):
+        """Store the filtered listing of the given dir, if it can be
+        trusted.
+        """
+        self._insert("dirs", path, st,
+                     (filter_key, '/'.join(dirnames), '/'.join(filenames)))
+
+    def _select(self, sql, path):
+        with self._lock:
+            return self._conn.execute(sql,
+                                      (os.path.abspath(path),)).fetchone()
+
+    def _insert(self, table, path, st, row):
+        if max(_st_ns(st, "mtime"), _st_ns(st, "ctime")) \
+           >= self.start_ns - self.RACY_NS:
+            return
+        row = (os.path.abspath(path), _stat_signature(st)) + tuple(row)
+        with self._lock:
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO %s VALUES (%s)"
+                    % (table, ", ".join("?" * len(row))), row)
+            except UnicodeEncodeError:
+                # An undecodable file name, e.g. on Python 3 on POSIX.
+                return
+            self._num_puts += 1
+            if self._num_puts % self.COMMIT_EVERY == 0:
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+class _AsyncIterator(object):
+    """An async iterator, and async context manager, over the (blocking)
+    iterator returned by `make_iter()`, which is created and advanced in
+    "executor" (by default a thread of its own).
+
+    This is written without `async` syntax to keep the module importable
+    on Python 2.
+    """
+    def __init__(self, make_iter, executor=None):
+        import threading
+        self._make_iter = make_iter
+        self._iter = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._own_executor = executor is None
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=1)
+        self._executor = executor
+
+    def _loop(self):
+        import asyncio
+        return getattr(asyncio, "get_running_loop",
+                       asyncio.get_event_loop)()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self._closed:
+            future = self._loop().create_future()
+            future.set_exception(StopAsyncIteration())
+            return future
+        return self._loop().run_in_executor(self._executor, self._next)
+
+    def _next(self):
+        with self._lock:
+            if self._closed:
+                raise StopAsyncIteration()
+            if self._iter is None:
+                self._iter = iter(self._make_iter())
+            try:
+                return next(self._iter)
+            except StopIteration:
+                raise StopAsyncIteration()
+
+    def aclose(self):
+        """Stop iterating, closing the underlying iterator (after the item
+        in progress, if any). Returns an awaitable.
+        """
+        if self._closed and self._iter is None:
+            future = self._loop().create_future()
+            future.set_result(None)
+            return future
+        self._closed = True
+        future = self._loop().run_in_executor(self._executor, self._close)
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+        return future
+
+    def _close(self):
+        with self._lock:
+            it, self._iter = self._iter, None
+            if hasattr(it, "close"):
+                it.close()
+
+    def __aenter__(self):
+        future = self._loop().create_future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, exc_type, exc_value, tb):
+        return self.aclose()
+
+def _until_set(event, iterable):
+    """Yield from the given iterable until the given `threading.Event` is
+    set.
+    """
+    for item in iterable:
+        if event.is_set():
+            break
+        yield item
+
+_eol_info_memo = None
+
+class _EolInfoMemo(object):
+    """A bounded, thread-safe LRU cache of eol_info_from_path() results,
+    validated by stat signature. See enable_eol_info_cache().
+
+    As with `_ScanCache`, results for files changed within `RACY_NS` of
+    being read aren't kept.
+    """
+    RACY_NS = _ScanCache.RACY_NS
+
+    def __init__(self, maxsize=1024):
+        import threading
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def eol_info_from_path(self, path):
+        import time
+        key = os.path.abspath(path)
+        # Stat before reading: if the file changes in between, the result
+        # is stored with the old signature and won't be used.
+        st = os.stat(path)
+        signature = _stat_signature(st)
+        with self._lock:
+            item = self._results.get(key)
+            if item is not None and item[0] == signature:
+                self.hits += 1
+                # Move to the most recently used end.
+                del self._results[key]
+                self._results[key] = item
+                return item[1]
+            self.misses += 1
+        result = eol_info_from_text(_read_path(path))
+        if max(_st_ns(st, "mtime"), _st_ns(st, "ctime")) \
+           < time.time() * 1e9 - self.RACY_NS:
+            with self._lock:
+                self._results.pop(key, None)
+                self._results[key] = (signature, result)
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+        return result
+
+    def info(self):
+        with self._lock:
+            return (self.hits, self.misses, self.maxsize,
+                    len(self._results))
+
+def _st_ns(st, name):
+    """Return the given `os.stat()` time ("mtime" or "ctime") in ns."""
+    ns = getattr(st, "st_%s_ns" % name, None)
+    if ns is None:
+        ns = int(getattr(st, "st_" + name) * 1e9)
+    return ns
+
+def _stat_signature(st):
+    return "%d %d %d %d" % (st.st_size, _st_ns(st, "mtime"), st.st_ino,
+                            _st_ns(st, "ctime"))
+
+def _convert_path_stats_eol(path_stats, eol, jobs=1,
+                            max_inflight=512 * 1024 * 1024,
+                            device_jobs=None, stream_size=256 * 1024 * 1024):
+    """Convert the files for the given (PATH, STAT) 2-tuples (in-place)
+    to the given EOL. See _rewrite_path_stats().
+    """
+    if eol not in (LF, CRLF, CR):
+        raise ValueError("illegal EOL: %r" % eol)
+    return _rewrite_path_stats(path_stats,
+        lambda path: convert_path_eol(path, eol, stream_size=stream_size),
+        jobs=jobs, max_inflight=max_inflight, device_jobs=device_jobs)
+
+def _rewrite_path_stats(path_stats, rewrite, jobs=1,
+                        max_inflight=512 * 1024 * 1024, device_jobs=None):
+    """Call `rewrite(PATH)` (e.g. to convert the file) for the files for
+    the given (PATH, STAT) 2-tuples. Empty regular files are skipped
+    without being opened.
+
+    Return a list of (PATH, ERROR) 2-tuples, in the given order, for the
+    files for which "rewrite" raised an `EnvironmentError`. These are
+    also logged as errors as they happen.
+
+    If "jobs" isn't 1, files are rewritten by a pool of "jobs" threads
+    (0 or None for `_cpu_count()`). A rewrite needs about three times the
+    file's size in memory (the content and the rewritten content, which
+    can be twice as big), and a file is only started while the total for
+    those in progress stays within "max_inflight" bytes. A bigger file is
+    rewritten on its own. "device_jobs", if given, limits the files
+    rewritten at a time per device instead: see `_DeviceExecutors`.
+    """
+    failures = []
+    if jobs == 1 and not device_jobs:
+        for path, st in path_stats:
+            if st is not None and st.st_size == 0 \
+               and stat.S_ISREG(st.st_mode):
+                log.debug("skipped `%s': empty file", path)
+                continue
+            ex = _rewrite_path(rewrite, path)
+            if ex is not None:
+                failures.append((path, ex))
+        return failures
+
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    if not jobs:
+        jobs = _cpu_count()
+    executor = _DeviceExecutors(ThreadPoolExecutor, jobs, device_jobs)
+    # The (INDEX, PATH, COST) of each file in progress.
+    item_from_future = {}
+    inflight = 0
+    indexed_failures = []
+    try:
+        for index, (path, st) in enumerate(path_stats):
+            if st is None:
+                st = _stat_or_none(path)
+            if st is not None and st.st_size == 0 \
+               and stat.S_ISREG(st.st_mode):
+                log.debug("skipped `%s': empty file", path)
+                continue
+            cost = st is not None and 3 * st.st_size or 0
+            while item_from_future \
+                  and (inflight + cost > max_inflight
+                       or len(item_from_future) >= 2 * executor.max_workers):
+                done, _ = wait(list(item_from_future),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    done_index, done_path, done_cost \
+                        = item_from_future.pop(future)
+                    inflight -= done_cost
+                    if future.result() is not None:
+                        indexed_failures.append(
+                            (done_index, done_path, future.result()))
+            future = executor.submit(st is not None and st.st_dev or None,
+                                     _rewrite_path, rewrite, path)
+            item_from_future[future] = (index, path, cost)
+            inflight += cost
+        for future in list(item_from_future):
+            index, path, cost = item_from_future.pop(future)
+            if future.result() is not None:
+                indexed_failures.append((index, path, future.result()))
+    finally:
+        for future in item_from_future:
+            future.cancel()
+        executor.shutdown(wait=True)
+    indexed_failures.sort()
+    return [(path, ex) for index, path, ex in indexed_failures]
+
+def _rewrite_path(rewrite, path):
+    """Call `rewrite(PATH)` and return None, or the `EnvironmentError` it
+    raised (after logging it).
+    """
+    try:
+        rewrite(path)
+    except EnvironmentError:
+        _, ex, _ = sys.exc_info()
+        log.error("`%s': %s", path, ex.strerror or ex)
+        return ex
+    return None
+
+def _convert_path_eol_streamed(path, eol, skip_binary_content=True,
+                               log=log, chunk_size=8 * 1024 * 1024):
+    """Convert the given file (in-place) to the given EOL a chunk at a
+    time: a first pass counts its EOLs and, if needed, a second one
+    writes the converted chunks to a temp file that replaces it.
+
+    Return False, without doing anything, if it can't be replaced that
+    way (see _replace_path()).
+    """
+    content = _StreamedContent(path, os.stat(path).st_size,
+                               chunk_size=chunk_size)
+    counter = content.count()
+    if skip_binary_content and counter.binary:
+        log.debug("skipped `%s': binary file (null in content)" % path)
+        return True
+    num_crlfs = counter.num_crlfs
+    num_eols = counter.num_crs + counter.num_lfs - num_crlfs
+    num_wanted = {CRLF: num_crlfs, CR: counter.num_crs - num_crlfs,
+                  LF: counter.num_lfs - num_crlfs}[eol]
+    if num_eols == num_wanted:
+        log.debug("skipped `%s': no change required", path)
+        return True
+
+    cr, lf, crlf = _eol_chars_from_text(_BYTES_EMPTY)
+    def write(fout):
+        # A CR ending a chunk is held back, as it may be the start of a
+        # CRLF.
+        held = _BYTES_EMPTY
+        for buf, end in content.chunks():
+            chunk = held + bytes(buf[:end])
+            held = chunk[-1:] == cr and cr or _BYTES_EMPTY
+            if held:
+                chunk = chunk[:-1]
+            fout.write(convert_text_eol(chunk, eol))
+        fout.write(convert_text_eol(held, eol))
+    if not _replace_path(path, write):
+        return False
+    log.info("converted `%s' to %s EOLs", path, name_from_eol(eol))
+    return True
+
+def _read_path(path):
+    fin = open(path, "rb")
+    try:
+        return fin.read()
+    finally:
+        fin.close()
+
+def _write_path(path, content):
+    """Replace the content of the given file.
+
+    The content is written to a temp file in the same dir, which is then
+    renamed over the file (keeping its permissions, owner and extended
+    attributes), so that other readers and a crash see either the old or
+    the new content. A file with multiple hardlinks (which a rename would
+    split up), whose owner or attributes can't be kept, or in a dir in
+    which a temp file can't be created, is written in place. As when
+    writing in place, a file that can't be opened for writing (e.g. a
+    read-only file) is an error.
+    """
+    if _replace_path(path, lambda fout: fout.write(content)):
+        return
+    fout = open(path, "wb")
+    try:
+        fout.write(content)
+    finally:
+        fout.close()
+
+def _replace_path(path, write):
+    """Replace the given file with a temp file in the same dir, written
+    with `write(FILE)`, that is then renamed over it (keeping its
+    permissions, owner and extended attributes, including ACLs). A
+    symlink's target is replaced.
+
+    Return False, without changing anything, if the file has multiple
+    hardlinks (which a rename would split up), a temp file can't be
+    created in its dir or the file's owner or attributes can't be kept.
+    Raise `EnvironmentError` if the file can't be opened for writing.
+    """
+    import tempfile
+    from os.path import basename, dirname, realpath
+    path = realpath(path)
+    st = os.stat(path)
+    if st.st_nlink > 1:
+        return False
+    # Fail as writing the file in place would, e.g. for a read-only file.
+    os.close(os.open(path, os.O_WRONLY))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(path),
+            prefix=".%s." % basename(path), suffix=".tmp")
+    except OSError:
+        return False
+    try:
+        fout = os.fdopen(fd, "wb")
+        try:
+            write(fout)
+        finally:
+            fout.close()
+        if not _copy_file_attrs(path, st, tmp_path):
+            os.remove(tmp_path)
+            return False
+        getattr(os, "replace", os.rename)(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+def _copy_file_attrs(src, src_st, dst):
+    """Give file `dst` the owner, permissions and extended attributes
+    (which include POSIX ACLs) of file `src`, whose `stat()` is `src_st`.
+
+    Return False if they can't all be copied, e.g. the owner (if not
+    running as root).
+    """
+    dst_st = os.stat(dst)
+    if (dst_st.st_uid, dst_st.st_gid) != (src_st.st_uid, src_st.st_gid):
+        try:
+            os.chown(dst, src_st.st_uid, src_st.st_gid)
+        except OSError:
+            _, ex, _ = sys.exc_info()
+            if ex.errno != errno.EPERM:
+                raise
+            return False
+    os.chmod(dst, stat.S_IMODE(src_st.st_mode))
+    if not hasattr(os, "listxattr"):
+        return True
+    try:
+        names = os.listxattr(src)
+    except OSError:
+        # E.g. ENOTSUP: no extended attributes on this filesystem.
+        return True
+    for name in names:
+        try:
+            os.setxattr(dst, name, os.getxattr(src, name))
+        except OSError:
+            return False
+    return True
+
+def _shard_from_str(s):
+    """Return the (I, N) shard for the given "I/N" string, as for
+    `eol --shard`.
+
+        >>> _shard_from_str("2/3")
+        (2, 3)
+    """
+    try:
+        index, count = [int(n) for n in s.split("/")]
+        if not 1 <= index <= count:
+            raise ValueError
+    except ValueError:
+        raise ValueError("invalid shard (expected I/N, 1 <= I <= N): %r"
+                         % s)
+    return index, count
+
+def _shard_from_path(path, count):
+    """Return the (1-based) shard of "count" shards that the given path is
+    in, from a CRC32 of the normalized path. This is the same on all
+    platforms and Python versions.
+
+        >>> _shard_from_path("src/eol.py", 4) == _shard_from_path(
+        ...     "./src//eol.py", 4)
+        True
+    """
+    import zlib
+    key = os.path.normpath(path).replace(os.sep, "/")
+    if sys.version_info[0] > 2:
+        key = key.encode("utf-8", "surrogateescape")
+    return (zlib.crc32(key) & 0xffffffff) % count + 1
+
+def _shard_path_stats(path_stats, shard, balance=False, file_cost=4096):
+    """Generate the (PATH, STAT) 2-tuples of the given ones that are in
+    the given (I, N) shard.
+
+    By default, a path's shard is from a hash of it (see
+    _shard_from_path()), so paths are sharded as they are generated. If
+    "balance" is true, all the paths are gathered first and then assigned,
+    biggest first, to the shard with the least bytes so far (taking
+    "file_cost" bytes per file as the cost of opening it), which gives
+    shards of about the same total size. For the shards to be disjoint,
+    all shards must be given the same paths, with the same sizes. A
+    STAT of None is filled in for this.
+    """
+    index, count = shard
+    if not balance:
+        for path, st in path_stats:
+            if _shard_from_path(path, count) == index:
+                yield path, st
+        return
+
+    import heapq
+    items = []
+    for path, st in path_stats:
+        if st is None:
+            st = _stat_or_none(path)
+        items.append((path, st))
+    order = sorted(range(len(items)), key=lambda i: (
+        -(items[i][1] is not None and items[i][1].st_size or 0),
+        items[i][0]))
+    loads = [(0, i) for i in range(1, count + 1)]
+    owned = set()
+    for i in order:
+        load, item_shard = heapq.heappop(loads)
+        if item_shard == index:
+            owned.add(i)
+        st = items[i][1]
+        heapq.heappush(loads, (load + file_cost
+            + (st is not None and st.st_size or 0), item_shard))
+    for i, item in enumerate(items):
+        if i in owned:
+            yield item
+
+def _json_from_eol_info(path, info):
+    """Return a JSON object (a line of `eol --json` output) for the given
+    path and (EOL, SUGGESTED-EOL[, FINAL-EOL, NUM-TRAILING-BLANK-LINES])
+    info. EOLs are given by name, e.g. "CRLF" or "MIXED", or null.
+    """
+    import json
+    def name(eol):
+        if eol is None:
+            return None
+        if eol is MIXED:
+            return "MIXED"
+        return name_from_eol(eol)
+    record = {"path": path, "eol": name(info[0]),
+              "suggested_eol": name(info[1])}
+    if len(info) > 2:
+        record["final_eol"] = name(info[2])
+        record["num_trailing_blank_lines"] = info[3]
+    return json.dumps(record, sort_keys=True)
+
+def _eol_info_from_json(s):
+    """Return (PATH, INFO) for the given `_json_from_eol_info()` output.
+
+        >>> _eol_info_from_json(_json_from_eol_info("a", (MIXED, LF)))
+        ('a', (<class 'eol.MIXED'>, '\\n'))
+    """
+    import json
+    record = json.loads(s)
+    def eol(name):
+        if name is None:
+            return None
+        return eol_from_name(name)
+    info = (eol(record["eol"]), eol(record["suggested_eol"]))
+    if "final_eol" in record:
+        info += (eol(record["final_eol"]),
+                 record["num_trailing_blank_lines"])
+    return record["path"], info
+
+def _paths_from_git_index(top, file_filter, dir_filter):
+    """Generate the paths of the files tracked by git under dir `top`,
+    as listed in the git index, rather than walking the dir.
+
+    Paths are yielded in index (i.e. sorted path) order, filtered by the
+    given _PathFilter's.
+    """
+    from os.path import abspath, join
+    root = _git_work_tree_root(top)
+    if root is None:
+        log.error("`%s': not in a git working tree", top)
+        return
+    prefix = abspath(top)[len(join(root, "")):].replace(os.sep, '/')
+    if prefix:
+        prefix += '/'
+    prefix_len = len(prefix)
+
+    dir_included_from_rel = {"": True}
+    def is_dir_included(rel_dir):
+        try:
+            return dir_included_from_rel[rel_dir]
+        except KeyError:
+            parent = rel_dir.rpartition('/')[0]
+            included = (is_dir_included(parent)
+                and dir_filter(join(top, rel_dir), rel_dir))
+            dir_included_from_rel[rel_dir] = included
+            return included
+
+    found_prefix = False
+    for index_path in _git_index_files(_git_index_path(root)):
+        if not index_path.startswith(prefix):
+            if found_prefix:
+                break   # paths under `top` are contiguous in the index
+            continue
+        found_prefix = True
+        rel = index_path[prefix_len:]
+        if not is_dir_included(rel.rpartition('/')[0]):
+            continue
+        if os.sep != '/':
+            f = join(top, rel.replace('/', os.sep))
+        else:
+            f = join(top, rel)
+        if file_filter(f, rel):
+            yield f
+
+def _git_work_tree_root(path):
+    """Return the root dir of the git working tree containing `path`, or
+    None if it isn't in one.
+    """
+    from os.path import abspath, dirname, exists, join
+    d = abspath(path)
+    while not exists(join(d, ".git")):
+        parent = dirname(d)
+        if parent == d:
+            return None
+        d = parent
+    return d
+
+def _git_index_path(root):
+    """Return the path to the index file of the given git working tree."""
+    from os.path import isfile, join, isabs
+    git_dir = join(root, ".git")
+    if isfile(git_dir):
+        # A "gitdir: PATH" link file, as for worktrees and submodules.
+        f = open(git_dir, "r")
+        try:
+            line = f.readline().strip()
+        finally:
+            f.close()
+        if line.startswith("gitdir:"):
+            git_dir = line[len("gitdir:"):].strip()
+            if not isabs(git_dir):
+                git_dir = join(root, git_dir)
+    return join(git_dir, "index")
+
+def _git_index_files(index_path):
+    """Generate the (root-relative, '/'-separated) paths of the regular
+    files tracked in the given git index file, in index order.
+
+    This parses the index (versions 2 to 4) directly: see
+    Documentation/technical/index-format.txt in git.git. Symlinks,
+    submodules and "skip-worktree" (sparse checkout) entries are skipped,
+    as are the extra entries for unmerged paths.
+    """
+    import struct
+    data = _read_path(index_path)
+    signature, version, num_entries = struct.unpack_from(">4sLL", data)
+    if signature != "DIRC".encode("ascii") or version not in (2, 3, 4):
+        raise ValueError("`%s' is not a supported git index file "
+                         "(version %r)" % (index_path, version))
+    NUL = _BYTES_NULL
+    unpack_from = struct.unpack_from
+    offset = 12
+    name = "".encode("ascii")
+    last_name = None
+    for i in range(num_entries):
+        mode, = unpack_from(">L", data, offset + 24)
+        flags, = unpack_from(">H", data, offset + 60)
+        name_offset = offset + 62
+        skip_worktree = False
+        if flags & 0x4000:    # extended flags
+            extended_flags, = unpack_from(">H", data, name_offset)
+            skip_worktree = bool(extended_flags & 0x4000)
+            name_offset += 2
+        if version == 4:
+            # The name is the previous name, less N trailing bytes, plus
+            # a NUL-terminated suffix, where N is a varint.
+            c = ord(data[name_offset:name_offset+1])
+            name_offset += 1
+            strip = c & 127
+            while c & 128:
+                c = ord(data[name_offset:name_offset+1])
+                name_offset += 1
+                strip = ((strip + 1) << 7) + (c & 127)
+            end = data.index(NUL, name_offset)
+            name = name[:len(name)-strip] + data[name_offset:end]
+            offset = end + 1
+        else:
+            name_len = flags & 0xfff
+            if name_len == 0xfff:
+                end = data.index(NUL, name_offset)
+            else:
+                end = name_offset + name_len
+            name = data[name_offset:end]
+            # Entries are NUL-padded to a multiple of 8 bytes.
+            offset += ((name_offset - offset) + (end - name_offset) + 8) & ~7
+        if (mode >> 12) != 8 or skip_worktree or name == last_name:
+            continue
+        last_name = name
+        yield os.fsdecode(name)
+
+def _compile_name_patterns(patterns):
+    """Return a `match(NAME) -> bool` function for the given `fnmatch`
+    patterns, or None if there are no patterns.
+    """
+    import re
+    from fnmatch import translate
+    from os.path import normcase
+    if not patterns:
+        return None
+    names = set()
+    suffixes = []
+    regexes = []
+    for pattern in patterns:
+        pattern = normcase(pattern)
+        if not _has_glob_chars(pattern):
+            names.add(pattern)
+        elif pattern.startswith('*') and not _has_glob_chars(pattern[1:]):
+            suffixes.append(pattern[1:])
+        else:
+            regexes.append(translate(pattern))
+    suffixes = tuple(suffixes)
+    regex_match = regexes and re.compile('|'.join(regexes)).match or None
+
+    def match(name):
+        if name in names:
+            return True
+        if suffixes and name.endswith(suffixes):
+            return True
+        return regex_match is not None and regex_match(name) is not None
+    return match
+
+def _compile_path_patterns(patterns):
+    """Return the `match` method of a regex for the given '/'-separated
+    path patterns, or None if there are no patterns.
+
+        >>> match = _compile_path_patterns(['build/**/gen', 'doc/*.txt'])
+        >>> [bool(match(p)) for p in ('build/gen', 'build/a/b/gen',
+        ...     'build/gen/x', 'doc/a.txt', 'doc/a/b.txt')]
+        [True, True, False, True, False]
+    """
+    import re
+    if not patterns:
+        return None
+    return re.compile('|'.join(_translate_path_pattern(p)
+                               for p in patterns), re.S).match
+
+def _translate_path_pattern(pattern):
+    """Translate a '/'-separated glob pattern to a regex string."""
+    parts = [p for p in pattern.split('/') if p]
+    res = []
+    for i, part in enumerate(parts):
+        last = (i == len(parts) - 1)
+        if part == "**":
+            res.append(last and ".*" or "(?:[^/]+/)*")
+            continue
+        res.append(_translate_part_pattern(part))
+        if not last:
+            res.append('/')
+    return "(?:%s)\\Z" % ''.join(res)
+
+def _has_glob_chars(s):
+    for glob_char in '*?[':
+        if glob_char in s:
+            return True
+    return False
+
+# Dirs skipped with `skip_vcs_dirs=True`.
+_VCS_DIR_NAMES = frozenset([".git", ".hg", ".svn", ".bzr", "_darcs", "CVS"])
+
+class _GitIgnore(object):
+    """The compiled patterns of one .gitignore (or .git/info/exclude)
+    file, matched against '/'-separated paths relative to its dir.
+
+        >>> gi = _GitIgnore(["*.o", "/build/", "!keep.o", "doc/**/*.tmp"])
+        >>> [gi.match(p, False) for p in ('a.o', 'x/keep.o', 'x/a.c')]
+        [True, False, None]
+        >>> [gi.match('build', True), gi.match('build', False),
+        ...  gi.match('x/build', True), gi.match('doc/a/b.tmp', False)]
+        [True, None, None, True]
+    """
+    def __init__(self, lines):
+        import re
+        # The (REGEX, NEGATED, DIR-ONLY) for each pattern, last first.
+        patterns = []
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith('#'):
+                continue
+            if not line.endswith("\\ "):
+                line = line.rstrip(' ')
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            if line.startswith('\\'):
+                line = line[1:]    # "\#foo" or "\!foo"
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            regex = _translate_path_pattern(line)
+            if '/' not in line:
+                # Not anchored: matches at any depth.
+                regex = "(?:[^/]+/)*" + regex
+            patterns.insert(0, (regex, negated, dir_only))
+        if [p for p in patterns if p[1]]:
+            # Last matching pattern wins, so must try them one by one.
+            self.patterns = [(re.compile(regex, re.S).match, negated,
+                              dir_only)
+                             for regex, negated, dir_only in patterns]
+        else:
+            # Without negated patterns one regex for each kind will do.
+            self.patterns = []
+            if patterns:
+                self.patterns.append((re.compile(
+                    '|'.join(p[0] for p in patterns), re.S).match,
+                    False, True))
+            any_regexes = [p[0] for p in patterns if not p[2]]
+            if any_regexes:
+                self.patterns.append((re.compile(
+                    '|'.join(any_regexes), re.S).match, False, False))
+
+    @classmethod
+    def from_path(cls, path):
+        """Return a _GitIgnore for the given file, or None if it can't be
+        read or has no patterns.
+        """
+        import codecs
+        try:
+            f = codecs.open(path, 'r', 'utf-8', 'replace')
+            try:
+                lines = f.read().splitlines()
+            finally:
+                f.close()
+        except EnvironmentError:
+            return None
+        gitignore = cls(lines)
+        return gitignore.patterns and gitignore or None
+
+    def match(self, relpath, is_dir):
+        """Return True if the given path is ignored, False if it is
+        explicitly not ignored (a '!' pattern) or None if no pattern
+        matches.
+        """
+        for match, negated, dir_only in self.patterns:
+            if dir_only and not is_dir:
+                continue
+            if match(relpath) is not None:
+                return not negated
+        return None
+
+def _gitignores_above(top):
+    """Return the .gitignore rules that apply to dir `top` from its parent
+    dirs in the same git working tree, and .git/info/exclude.
+
+    The rules are a list of (STRIP, PREFIX, GITIGNORE), deepest first,
+    where the path relative to the ignore file's dir is:
+        PREFIX + RELPATH[STRIP:]
+    for RELPATH the '/'-separated path relative to `top`.
+    """
+    from os.path import abspath, dirname, exists, join
+    top_abs = abspath(top)
+    dirs_above = []
+    d = top_abs
+    while True:
+        if exists(join(d, ".git")):
+            break
+        parent = dirname(d)
+        if parent == d:
+            # Not in a git working tree: only use .gitignore files found
+            # while walking.
+            return []
+        d = parent
+        dirs_above.append(d)
+    rules = []
+    for d in dirs_above:
+        gitignore = _GitIgnore.from_path(join(d, ".gitignore"))
+        if gitignore is not None:
+            prefix = top_abs[len(join(d, "")):].replace(os.sep, '/') + '/'
+            rules.append((0, prefix, gitignore))
+    exclude = _GitIgnore.from_path(join(d, ".git", "info", "exclude"))
+    if exclude is not None:
+        prefix = top_abs[len(join(d, "")):].replace(os.sep, '/')
+        rules.append((0, prefix and prefix + '/' or '', exclude))
+    return rules
+
+def _is_gitignored(rules, relpath, is_dir):
+    """Return True iff the given path (relative to the searched dir) is
+    ignored by the given rules (see _gitignores_above()).
+    """
+    for strip, prefix, gitignore in rules:
+        ignored = gitignore.match(prefix + relpath[strip:], is_dir)
+        if ignored is not None:
+            return ignored
+    return False
+
+def _paths_from_list_file(path, sep="\n"):
+    """Generate the paths listed in the given file ("-" for stdin),
+    separated by newlines (the default) or the given `sep`, e.g. "\\0".
+
+    The list is streamed: paths are yielded as soon as they are read.
+    """
+    if path == "-":
+        stream = getattr(sys.stdin, "buffer", sys.stdin)
+    else:
+        stream = open(path, "rb")
+    read = getattr(stream, "read1", stream.read)
+    sep = sep.encode("ascii")
+    strip_cr = (sep == "\n".encode("ascii"))
+    try:
+        pending = sep[:0]
+        while True:
+            chunk = read(65536)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(sep)
+            pending = lines.pop()
+            for line in lines:
+                if strip_cr and line.endswith("\r".encode("ascii")):
+                    line = line[:-1]
+                if line:
+                    yield os.fsdecode(line)
+        if pending:
+            yield os.fsdecode(pending)
+    finally:
+        if stream is not getattr(sys.stdin, "buffer", sys.stdin):
+            stream.close()
+
+def _listed_path_stats(paths):
+    """Generate (PATH, STAT) 2-tuples for the given listed file paths
+    (e.g. from `--files-from`), skipping, with a log message, those that
+    aren't regular files (e.g. dirs). STAT is None for a path that can't
+    be `stat()`ed: the error is reported when it is read.
+    """
+    for path in paths:
+        st = _stat_or_none(path)
+        if st is not None and not stat.S_ISREG(st.st_mode):
+            log.warning("skipped `%s': not a regular file", path)
+            continue
+        yield path, st
+
+def _size_from_str(s):
+    """Return the number of bytes for the given size string: a number
+    with an optional K, M or G suffix (powers of 1024).
+
+    >>> _size_from_str("100")
+    100
+    >>> _size_from_str("512M") == 512 * 1024 * 1024
+    True
+    >>> _size_from_str("1.5k")
+    1536
+    """
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    multiplier = multipliers.get(s[-1:].upper())
+    try:
+        if multiplier:
+            size = int(float(s[:-1]) * multiplier)
+        else:
+            size = int(s)
+    except ValueError:
+        raise ValueError("invalid size: %r" % s)
+    if size < 0:
+        raise ValueError("invalid size: %r" % s)
+    return size
+
+def _stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+def _is_size_in_range(st, min_size=None, max_size=None):
+    """Return True iff the given `os.stat()` result is for a regular file
+    with a size in the given (inclusive) range, or isn't for a regular
+    file at all (e.g. None for a file that can't be stat'd).
+    """
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return True
+    if min_size is not None and st.st_size < min_size:
+        return False
+    if max_size is not None and st.st_size > max_size:
+        return False
+    return True
+
+def _is_new_file(keys, entry, dev=None):
+    """Return True iff the given file (a DirEntry or path) isn't in the
+    given set of `(st_dev, st_ino)` keys, adding it if not.
+
+    "dev" is the `st_dev` of the file's dir, if known. For a DirEntry
+    that isn't a symlink this avoids a `stat()`.
+    """
+    try:
+        if dev is not None and os.name != "nt" \
+           and not entry.is_symlink():
+            key = (dev, entry.inode())
+        else:
+            st = _stat_entry(entry)
+            key = (st.st_dev, st.st_ino)
+    except OSError:
+        return True
+    if key in keys:
+        log.debug("skip `%s': file already seen",
+                  getattr(entry, "path", entry))
+        return False
+    keys.add(key)
+    return True
+
+def _is_new_dir(keys, entry):
+    """Return True iff the given dir (a DirEntry or path) isn't in the
+    given set of `(st_dev, st_ino)` keys, adding it if not.
+    """
+    try:
+        st = _stat_entry(entry)
+    except OSError:
+        return True
+    key = (st.st_dev, st.st_ino)
+    if key in keys:
+        log.debug("skip `%s': dir already walked",
+                  getattr(entry, "path", entry))
+        return False
+    keys.add(key)
+    return True
+
+def _stat_entry(entry):
+    """Return the `os.stat()` (following symlinks) of the given DirEntry
+    or path.
+
+    On POSIX a DirEntry caches this. On Windows `DirEntry.stat()` doesn't
+    fill in `st_dev` and `st_ino`, so it is no use as a file identity.
+    """
+    if not isinstance(entry, _BASESTRING) and os.name != "nt":
+        return entry.stat()
+    return os.stat(getattr(entry, "path", entry))
+
+def _translate_part_pattern(part):
+    """Translate a glob pattern for a single path component to a regex
+    string. "{a,b}" alternatives are supported.
+
+        >>> _translate_part_pattern("*.{c,h}")
+        '[^/]*\\\\.(?:c|h)'
+    """
+    import re
+    res = []
+    j, n = 0, len(part)
+    while j < n:
+        c = part[j]
+        j += 1
+        if c == '*':
+            res.append("[^/]*")
+        elif c == '?':
+            res.append("[^/]")
+        elif c == '[':
+            k = part.find(']', j + 1)
+            if k == -1:
+                res.append("\\[")
+            else:
+                chars = part[j:k].replace('\\', '\\\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                res.append('[%s]' % chars)
+                j = k + 1
+        elif c == '{':
+            k = part.find('}', j)
+            if k == -1 or ',' not in part[j:k]:
+                res.append("\\{")
+            else:
+                res.append("(?:%s)" % '|'.join(_translate_part_pattern(alt)
+                    for alt in part[j:k].split(',')))
+                j = k + 1
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+def _compile_part_pattern(part):
+    """Return a `match(NAME) -> bool` function for the given glob pattern
+    for a single path component. As with `glob`, wildcards don't match a
+    leading '.'.
+    """
+    import re
+    from os.path import normcase
+    part = normcase(part)
+    if not (_has_glob_chars(part) or _is_iglob_pattern(part)):
+        return lambda name: name == part
+    regex_match = re.compile(_translate_part_pattern(part) + "\\Z",
+                             re.S).match
+    if part.startswith('.'):
+        return lambda name: regex_match(name) is not None
+    return lambda name: not name.startswith('.') \
+                        and regex_match(name) is not None
+
+def _is_iglob_pattern(path_pattern):
+    """Return True iff the given path pattern uses '**' or '{a,b}'
+    alternatives, i.e. needs `_iglob()` rather than `glob.glob()`.
+    """
+    import re
+    return "**" in path_pattern \
+        or re.search(r"\{[^{}]*,[^{}]*\}", path_pattern) is not None
+
+def _iglob(pattern, follow_symlinks=False, walk_threads=0, ordered=True,
+           dir_filter=None, skip_vcs_dirs=False):
+    """Generate the paths matching the given glob pattern.
+
+    As well as the usual '*', '?' and '[seq]', a "**" path component
+    matches any number of dirs (including none) and "{a,b}" matches
+    either alternative, e.g. "src/**/*.{c,h}". As with `glob`, wildcards
+    don't match names starting with a '.'.
+
+    Matches are generated as the dirs are walked, starting at the longest
+    leading part of the pattern without wildcards. Each dir is matched
+    against the pattern components as it is listed and only dirs that
+    could lead to a match are walked. Within a dir, matches are in name
+    order if "ordered" is true.
+
+    Dirs for which "dir_filter" (a `_PathFilter`, given the path as
+    generated) is false and, if "skip_vcs_dirs", VCS dirs are neither
+    matched nor walked, as in `_paths_from_walk()`.
+
+    As with `glob.glob(..., recursive=True)`, each path is generated once,
+    a pattern ending in a '/' only matches dirs and a "**" matching no
+    dirs can't follow a file name (e.g. "src/*/**" doesn't match
+    "src/f.c").
+    """
+    from os.path import isdir, join, normcase
+
+    if os.sep != '/':
+        pattern = pattern.replace(os.sep, '/')
+    dirs_only = pattern.endswith('/')
+    parts = pattern.split('/')
+    i = 0
+    while i < len(parts) and not (_has_glob_chars(parts[i])
+                                  or _is_iglob_pattern(parts[i])):
+        i += 1
+    base = '/'.join(parts[:i]) or (i and '/' or os.curdir)
+    # Matches under the current dir are generated without a "./" prefix.
+    strip = (i == 0) and len(join(os.curdir, "")) or 0
+    if not isdir(base):
+        return
+    if i and dir_filter is not None and not dir_filter(base, base):
+        return
+
+    # A "**" component is None, others a `match(NAME) -> bool` function.
+    matchers = [part != "**" and _compile_part_pattern(part) or None
+                for part in parts[i:] if part]
+    end = len(matchers)
+
+    def closure(states):
+        # A "**" can match no dirs at all.
+        states = set(states)
+        for state in sorted(states):
+            while state < end and matchers[state] is None:
+                state += 1
+                states.add(state)
+        return states
+
+    def advance(states, name):
+        next_states = []
+        for state in states:
+            if state == end:
+                continue
+            matcher = matchers[state]
+            if matcher is None:
+                if not name.startswith('.'):
+                    next_states.append(state)
+            elif matcher(name):
+                next_states.append(state + 1)
+        return next_states and closure(next_states) or None
+
+    def matches_file(states, name):
+        for state in states:
+            if state == end:
+                continue
+            matcher = matchers[state]
+            if matcher is None:
+                if not name.startswith('.') and end in closure([state]):
+                    return True
+            elif state + 1 == end and matcher(name):
+                return True
+        return False
+
+    states = closure([0])
+    if end in states and i:
+        yield base
+    states_from_dir = {base: states}
+    for dirpath, dir_entries, file_entries in _dir_walker(base,
+            follow_symlinks=follow_symlinks, walk_threads=walk_threads,
+            ordered=ordered):
+        states = states_from_dir.pop(dirpath)
+        matches = []
+        dir_indeces_to_remove = []
+        for i, dir_entry in enumerate(dir_entries):
+            if skip_vcs_dirs and dir_entry.name in _VCS_DIR_NAMES:
+                dir_indeces_to_remove.append(i)
+                continue
+            if dir_filter is not None \
+               and not dir_filter(dir_entry.path, dir_entry.path[strip:]):
+                dir_indeces_to_remove.append(i)
+                continue
+            dir_states = advance(states, normcase(dir_entry.name))
+            if dir_states is None:
+                dir_indeces_to_remove.append(i)
+                continue
+            if end in dir_states:
+                matches.append(dir_entry)
+                if len(dir_states) == 1:
+                    dir_indeces_to_remove.append(i)
+                    continue
+            states_from_dir[dir_entry.path] = dir_states
+        for i in reversed(dir_indeces_to_remove):
+            del dir_entries[i]
+        if not dirs_only:
+            for file_entry in file_entries:
+                if matches_file(states, normcase(file_entry.name)):
+                    matches.append(file_entry)
+        if ordered:
+            matches.sort(key=_entry_name)
+        for entry in matches:
+            yield entry.path[strip:]
+
+def _paths_not_under_dirs(paths, follow_symlinks=False):
+    """Generate the given paths (as from `_iglob()`), less those under a
+    dir generated before them: in a recursive search that dir is walked
+    anyway. E.g. "src/**" matches "src", "src/a" and "src/a/f.c", but
+    only "src" need be walked.
+    """
+    from os.path import dirname, isdir, islink
+    walked_dirs = set()
+    for path in paths:
+        d, parent = path, dirname(path)
+        while parent and parent != d and parent not in walked_dirs:
+            d, parent = parent, dirname(parent)
+        if parent and parent in walked_dirs:
+            continue
+        if (follow_symlinks or not islink(path)) and isdir(path):
+            walked_dirs.add(path)
+        yield path
+
+def _dir_walker(top, follow_symlinks=False, walk_threads=0, ordered=True,
+                lister=None):
+    """Return `_walk_entries()` for `top`, or `_walk_entries_parallel()`
+    if "walk_threads" is non-zero.
+    """
+    if walk_threads:
+        return _walk_entries_parallel(top, follow_symlinks=follow_symlinks,
+                                      workers=walk_threads, ordered=ordered,
+                                      lister=lister)
+    return _walk_entries(top, follow_symlinks=follow_symlinks,
+                         lister=lister)
+
+def _walk_entries_parallel(top, onerror=None, follow_symlinks=False,
+                           workers=4, ordered=True, max_pending=None,
+                           lister=None):
+    """A topdown-only `_walk_entries()` that lists up to "workers" dirs
+    at a time in a thread pool. This helps on high-latency filesystems
+    (e.g. NFS) where the walk is dominated by waiting on each listing.
+
+        "ordered" is a boolean (default True). If true, dirs are yielded
+            in the same order as with `_walk_entries()`: the next dirs
+            to be yielded are listed ahead of time. If false, each dir
+            is yielded as soon as its listing is done.
+        "max_pending" is the maximum number of listings queued or
+            running at any time (default 4 * workers).
+        "lister" is the function to list a dir with (default
+            `_scandir()`). It is called from the pool's threads.
+
+    As with `_walk()`, removing entries from the yielded dir entries
+    prunes the walk: subdirs are only queued for listing once the
+    generator is resumed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    if max_pending is None:
+        max_pending = 4 * workers
+    if lister is None:
+        lister = _scandir
+    if follow_symlinks:
+        walked_keys = set()
+        _is_new_dir(walked_keys, top)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # Ordered: a stack of [DIRPATH, FUTURE] items walked depth-first, the
+    # top "max_pending" of which are listed ahead.
+    stack = []
+    # Unordered: the listings being done.
+    dirpath_from_future = {}
+    try:
+        if ordered:
+            stack.append([top, None])
+            num_pending = 0
+            while stack:
+                for item in stack[-1:-max_pending-1:-1]:
+                    if num_pending >= max_pending:
+                        break
+                    if item[1] is None:
+                        item[1] = executor.submit(lister, item[0],
+                                                  follow_symlinks)
+                        num_pending += 1
+                dirpath, future = stack.pop()
+                try:
+                    if future is None:
+                        dirs, nondirs = lister(dirpath, follow_symlinks)
+                    else:
+                        num_pending -= 1
+                        dirs, nondirs = future.result()
+                except OSError:
+                    _, err, _ = sys.exc_info()
+                    if onerror is not None:
+                        onerror(err)
+                    continue
+                yield dirpath, dirs, nondirs
+                for entry in reversed(dirs):
+                    if follow_symlinks \
+                       and not _is_new_dir(walked_keys, entry):
+                        continue
+                    stack.append([entry.path, None])
+        else:
+            to_list = [top]
+            while to_list or dirpath_from_future:
+                while to_list and len(dirpath_from_future) < max_pending:
+                    dirpath = to_list.pop()
+                    future = executor.submit(lister, dirpath,
+                                             follow_symlinks)
+                    dirpath_from_future[future] = dirpath
+                done, _ = wait(list(dirpath_from_future),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    dirpath = dirpath_from_future.pop(future)
+                    try:
+                        dirs, nondirs = future.result()
+                    except OSError:
+                        _, err, _ = sys.exc_info()
+                        if onerror is not None:
+                            onerror(err)
+                        continue
+                    yield dirpath, dirs, nondirs
+                    for entry in reversed(dirs):
+                        if follow_symlinks \
+                           and not _is_new_dir(walked_keys, entry):
+                            continue
+                        to_list.append(entry.path)
+    finally:
+        for future in [item[1] for item in stack] + list(dirpath_from_future):
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
+
+def _scandir(path, follow_symlinks=False):
+    """Return (DIR-ENTRIES, NONDIR-ENTRIES) for the given dir.
+
+    A symlink to a dir is a non-dir unless following symlinks.
+    """
+    dirs, nondirs = [], []
+    scandir_it = os.scandir(path)
+    try:
+        for entry in scandir_it:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append(entry)
+            else:
+                nondirs.append(entry)
+    finally:
+        scandir_it.close()
+    return dirs, nondirs
+
+class _CachedDirEntry(object):
+    """An `os.DirEntry` stand-in for a name from a cached dir listing
+    (see `_ScanCache.get_dir()`). `stat()` is done on first use.
+    """
+    __slots__ = ("name", "path", "_stat")
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def inode(self):
+        return self.stat().st_ino
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+## {{{ http://code.activestate.com/recipes/577230/ (r4)
+class _PathFilter(object):
+    """A compiled set of include and exclude patterns for deciding if a
+    path should be included.
+
+    Patterns without a '/' are matched against the basename of a path,
+    as with `fnmatch`. Exact names (e.g. ".svn") and simple suffix
+    patterns (e.g. "*.py") are matched with set and `endswith` lookups,
+    the rest with a single regex, and the decision is cached per
+    basename.
+
+    Patterns with a '/' are matched against the path relative to the
+    searched dir (or the path as given, for paths that aren't under a
+    searched dir). In these '*' and '?' don't match a '/' and a '**'
+    component matches any number of dirs, e.g. "build/**/gen".
+    """
+    _max_cache_size = 100000
+
+    def __init__(self, includes=None, excludes=None):
+        self.includes = includes or []
+        self.excludes = excludes or []
+        self._include_name = _compile_name_patterns(
+            [p for p in self.includes if '/' not in p])
+        self._exclude_name = _compile_name_patterns(
+            [p for p in self.excludes if '/' not in p])
+        self._include_path = _compile_path_patterns(
+            [p for p in self.includes if '/' in p])
+        self._exclude_path = _compile_path_patterns(
+            [p for p in self.excludes if '/' in p])
+        self.has_path_patterns = bool(self._include_path
+                                      or self._exclude_path)
+        # basename -> (name-included, name-excluded)
+        self._info_from_name = {}
+        self._debug = log.isEnabledFor(logging.DEBUG)
+
+    def __call__(self, path, relpath=None):
+        """Return True iff the given path should be included.
+
+        "relpath" is the path relative to the searched dir, for matching
+        patterns with a '/'.
+        """
+        from os.path import basename, normcase
+        name = normcase(basename(path))
+        try:
+            name_included, name_excluded = self._info_from_name[name]
+        except KeyError:
+            name_included = (not self.includes
+                or (self._include_name is not None
+                    and self._include_name(name)))
+            name_excluded = (self._exclude_name is not None
+                and self._exclude_name(name))
+            if len(self._info_from_name) >= self._max_cache_size:
+                self._info_from_name.clear()
+            self._info_from_name[name] = (name_included, name_excluded)
+
+        if self.has_path_patterns:
+            from os.path import normpath
+            if relpath is None:
+                relpath = normpath(path)
+            if os.sep != '/':
+                relpath = relpath.replace(os.sep, '/')
+            included = (name_included
+                or (self._include_path is not None
+                    and self._include_path(relpath) is not None))
+            excluded = (name_excluded
+                or (self._exclude_path is not None
+                    and self._exclude_path(relpath) is not None))
+        else:
+            included, excluded = name_included, name_excluded
+
+        if self._debug:
+            if not included:
+                log.debug("exclude `%s' (matches no includes)", path)
+            elif excluded:
+                log.debug("exclude `%s' (matches an exclude)", path)
+            elif self.includes:
+                log.debug("include `%s' (matches an include)", path)
+        return included and not excluded
+
+def _walk(top, topdown=True, onerror=None, follow_symlinks=False):
+    """A version of `os.walk()` with a couple differences regarding symlinks.
+
+    1. follow_symlinks=False (the default): A symlink to a dir is
+       returned as a *non*-dir. In `os.walk()`, a symlink to a dir is
+       returned in the *dirs* list, but it is not recursed into.
+    2. follow_symlinks=True: A symlink to a dir is returned in the
+       *dirs* list (as with `os.walk()`) but it *is conditionally*
+       recursed into (unlike `os.walk()`).
+
+       A dir is only recursed into if it hasn't already been walked,
+       going by its `(st_dev, st_ino)`. This guards against symlink
+       loops and walking the same dir twice via symlinks, as with
+       `find -L DIR`.
+
+    As with `os.walk()`, removing names from the yielded *dirs* list
+    (when topdown=True) prunes the walk.
+    """
+    for dirpath, dir_entries, nondir_entries in _walk_entries(top,
+            topdown, onerror, follow_symlinks=follow_symlinks):
+        dirnames = [e.name for e in dir_entries]
+        yield dirpath, dirnames, [e.name for e in nondir_entries]
+        if topdown and len(dirnames) != len(dir_entries):
+            keep = set(dirnames)
+            dir_entries[:] = [e for e in dir_entries if e.name in keep]
+
+def _walk_entries(top, topdown=True, onerror=None, follow_symlinks=False,
+                  lister=None):
+    """Like `_walk()`, but yields `os.DirEntry` lists:
+
+        (DIRPATH, DIR-ENTRIES, NONDIR-ENTRIES)
+
+    The dir/non-dir classification uses the file type info returned
+    with the directory listing (`d_type` on most Unix filesystems), so
+    walking does not need a `stat()` per entry.
+
+    This walks with an explicit stack rather than recursing, so the cost
+    per yielded dir does not grow with tree depth and arbitrarily deep
+    trees don't hit the recursion limit.
+
+    "lister" is the function to list a dir with (default `_scandir()`).
+    """
+    if lister is None:
+        lister = _scandir
+    if follow_symlinks:
+        walked_keys = set()
+        _is_new_dir(walked_keys, top)
+    stack = [top]
+    while stack:
+        top = stack.pop()
+        if type(top) is tuple:
+            # A bottom-up dir, all of whose subdirs have been walked.
+            yield top
+            continue
+
+        # We may not have read permission for top, in which case we can't
+        # get a list of the files the directory contains.  os.path.walk
+        # always suppressed the exception then, rather than blow up for a
+        # minor reason when (say) a thousand readable directories are
+        # still left to visit.  That logic is copied here.
+        try:
+            dirs, nondirs = lister(top, follow_symlinks)
+        except OSError:
+            _, err, _ = sys.exc_info()
+            if onerror is not None:
+                onerror(err)
+            continue
+
+        if topdown:
+            yield top, dirs, nondirs
+        else:
+            stack.append((top, dirs, nondirs))
+        # Push subdirs in reverse to walk them in listing order.
+        for entry in reversed(dirs):
+            if follow_symlinks and not _is_new_dir(walked_keys, entry):
+                continue
+            stack.append(entry.path)
+
+def _entry_name(entry):
+    return entry.name
+
+_NOT_SPECIFIED = ("NOT", "SPECIFIED")
+def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
+                              recursive=True, includes=None, excludes=None,
+                              skip_dupe_dirs=False, skip_dupe_files=False,
+                              follow_symlinks=False,
+                              on_error=_NOT_SPECIFIED,
+                              walk_threads=0, ordered=True,
+                              skip_vcs_dirs=False, respect_gitignore=False,
+                              git_index=False, min_size=None, max_size=None,
+                              with_stat=False, cache=None):
+    """_paths_from_path_patterns([<path-patterns>, ...]) -> file paths
+
+    Generate a list of paths (files and/or dirs) represented by the given path
+    patterns.
+
+        "path_patterns" is a list of paths optionally using the '*', '?' and
+            '[seq]' glob patterns. Patterns using '**' (any number of
+            dirs) or '{a,b}' alternatives are expanded as the dirs are
+            walked, only walking dirs that can lead to a match. See
+            `_iglob()`.
+        "files" is boolean (default True) indicating if file paths
+            should be yielded
+        "dirs" is string indicating under what conditions dirs are
+            yielded. It must be one of:
+              never             (default) never yield dirs
+              always            yield all dirs matching given patterns
+              if-not-recursive  only yield dirs for invocations when
+                                recursive=False
+            See use cases below for more details.
+        "recursive" is boolean (default True) indicating if paths should
+            be recursively yielded under given dirs.
+        "includes" is a list of file patterns to include in recursive
+            searches.
+        "excludes" is a list of file and dir patterns to exclude.
+            (Note: This is slightly different than GNU grep's --exclude
+            option which only excludes *files*.  I.e. you cannot exclude
+            a ".svn" dir.) Excluded dirs are not recursed into.
+            Include and exclude patterns are matched against basenames,
+            unless they contain a '/'. See `_PathFilter` for details.
+        "skip_dupe_dirs" can be set True to watch for and skip
+            descending into a dir that has already been yielded, e.g.
+            for overlapping path patterns. Dirs are identified by their
+            `(st_dev, st_ino)`, so this catches the same dir reached via
+            symlinks too.
+        "skip_dupe_files" can be set True to not yield a file that has
+            already been yielded (going by `(st_dev, st_ino)`, i.e.
+            including other hardlinks and symlinks to it). For files
+            found walking a dir this doesn't need any extra `stat()`s.
+            Symlinks to files are yielded after all other files, so a
+            file reached both directly and via a symlink is yielded
+            under its own path. Of hardlinks, the first found is yielded.
+        "follow_symlinks" is a boolean indicating whether to follow
+            symlinks (default False). To guard against infinite loops
+            with circular dir symlinks, a dir is not walked again if
+            already walked from the same searched dir.
+        "on_error" is an error callback called when a given path pattern
+            matches nothing:
+                on_error(PATH_PATTERN)
+            If not specified, the default is look for a "log" global and
+            call:
+                log.error("`%s': No such file or directory")
+            Specify None to do nothing.
+        "walk_threads" is the number of threads with which to list dirs
+            concurrently in recursive searches (default 0, meaning to
+            list one dir at a time in the calling thread).
+        "ordered" is a boolean (default True) indicating whether paths
+            are yielded in a deterministic order: dirs depth-first in
+            listing order and files sorted by name within a dir. If
+            false, paths are yielded as soon as they are found.
+        "skip_vcs_dirs" is a boolean (default False) indicating whether
+            to skip VCS metadata dirs (".git", ".hg", ".svn", etc.) in
+            recursive searches.
+        "respect_gitignore" is a boolean (default False) indicating
+            whether to skip paths ignored by git (per ".gitignore" files
+            and ".git/info/exclude") in recursive searches. Ignored dirs
+            are not walked.
+        "git_index" is a boolean (default False). If true, the files
+            under a dir are listed from the git index of the working
+            tree it is in instead of walking the dir, as if `recursive`
+            were true. Only tracked files are yielded (less those
+            deleted from the work tree) and untracked dirs are never
+            listed.
+        "min_size" and "max_size", if given, are the size limits (in
+            bytes, inclusive) for regular files to be yielded. Files
+            found walking a dir are `stat()`ed via their DirEntry (and
+            files listed from a git index are `stat()`ed), so files out
+            of range are skipped without being opened.
+        "with_stat" is a boolean (default False). If true, 2-tuples
+            (PATH, STAT) are yielded, where STAT is the `os.stat()` of a
+            file (following symlinks), or None for dirs and files that
+            can't be stat'd.
+        "cache" is an optional `_ScanCache` with which to skip listing
+            (and filtering) dirs that haven't changed in recursive
+            searches.
+
+    Typically this is useful for a command-line tool that takes a list
+    of paths as arguments. (For Unix-heads: the shell on Windows does
+    NOT expand glob chars, that is left to the app.)
+
+    Use case #1: like `grep -r`
+      {files=True, dirs='never', recursive=(if '-r' in opts)}
+        script FILE     # yield FILE, else call on_error(FILE)
+        script DIR      # yield nothing
+        script PATH*    # yield all files matching PATH*; if none,
+                        # call on_error(PATH*) callback
+        script -r DIR   # yield files (not dirs) recursively under DIR
+        script -r PATH* # yield files matching PATH* and files recursively
+                        # under dirs matching PATH*; if none, call
+                        # on_error(PATH*) callback
+
+    Use case #2: like `file -r` (if it had a recursive option)
+      {files=True, dirs='if-not-recursive', recursive=(if '-r' in opts)}
+        script FILE     # yield FILE, else call on_error(FILE)
+        script DIR      # yield DIR, else call on_error(DIR)
+        script PATH*    # yield all files and dirs matching PATH*; if none,
+                        # call on_error(PATH*) callback
+        script -r DIR   # yield files (not dirs) recursively under DIR
+        script -r PATH* # yield files matching PATH* and files recursively
+                        # under dirs matching PATH*; if none, call
+                        # on_error(PATH*) callback
+
+    Use case #3: kind of like `find .`
       {files=True, dirs='always', recursive=(if '-r' in opts)}
         script FILE     # yield FILE, else call on_error(FILE)
         script DIR      # yield DIR, else call on_error(DIR)
@@ -541,30 +3610,48 @@ def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
                         # under dirs; if none, call on_error(PATH*)
                         # callback
     """
-    from os.path import basename, exists, isdir, join, normpath, abspath, \
-                        lexists, islink, realpath
+    from os.path import exists, isdir, lexists, islink
     from glob import glob
+    from itertools import chain
 
     assert not isinstance(path_patterns, _BASESTRING), \
         "'path_patterns' must be a sequence, not a string: %r" % path_patterns
     if includes is None: includes = []
     if excludes is None: excludes = []
-    GLOB_CHARS = '*?['
+    file_filter = _PathFilter(includes, excludes)
+    dir_filter = _PathFilter([], excludes)
+    check_size = min_size is not None or max_size is not None
 
+    # The `(st_dev, st_ino)` of searched dirs and yielded files.
+    searched_dirs = seen_files = None
+    # Symlinks to files, held back until the other files are yielded so
+    # that a file reached both directly and via a symlink is yielded
+    # under its own path.
+    symlinked_files = None
     if skip_dupe_dirs:
         searched_dirs = set()
+    if skip_dupe_files:
+        seen_files = set()
+        symlinked_files = []
 
     for path_pattern in path_patterns:
         # Determine the set of paths matching this path_pattern.
-        for glob_char in GLOB_CHARS:
-            if glob_char in path_pattern:
-                paths = glob(path_pattern)
-                break
+        if _is_iglob_pattern(path_pattern):
+            # Expand lazily, only listing dirs that can lead to a match.
+            paths = _iglob(path_pattern, follow_symlinks=follow_symlinks,
+                           walk_threads=walk_threads, ordered=ordered,
+                           dir_filter=dir_filter,
+                           skip_vcs_dirs=skip_vcs_dirs)
+            if recursive:
+                paths = _paths_not_under_dirs(paths, follow_symlinks)
+            first = next(paths, None)
+            paths = first is not None and chain([first], paths) or []
+        elif _has_glob_chars(path_pattern):
+            paths = glob(path_pattern)
+        elif follow_symlinks:
+            paths = exists(path_pattern) and [path_pattern] or []
         else:
-            if follow_symlinks:
-                paths = exists(path_pattern) and [path_pattern] or []
-            else:
-                paths = lexists(path_pattern) and [path_pattern] or []
+            paths = lexists(path_pattern) and [path_pattern] or []
         if not paths:
             if on_error is None:
                 pass
@@ -578,55 +3665,258 @@ def _paths_from_path_patterns(path_patterns, files=True, dirs="never",
 
         for path in paths:
             if (follow_symlinks or not islink(path)) and isdir(path):
-                if skip_dupe_dirs:
-                    canon_path = normpath(abspath(path))
-                    if follow_symlinks:
-                        canon_path = realpath(canon_path)
-                    if canon_path in searched_dirs:
-                        continue
-                    else:
-                        searched_dirs.add(canon_path)
+                if searched_dirs is not None \
+                   and not _is_new_dir(searched_dirs, path):
+                    continue
 
                 # 'includes' SHOULD affect whether a dir is yielded.
                 if (dirs == "always"
                     or (dirs == "if-not-recursive" and not recursive)
-                   ) and _should_include_path(path, includes, excludes):
-                    yield path
+                   ) and file_filter(path):
+                    yield with_stat and (path, None) or path
 
                 # However, if recursive, 'includes' should NOT affect
                 # whether a dir is recursed into. Otherwise you could
                 # not:
                 #   script -r --include="*.py" DIR
-                if recursive and _should_include_path(path, [], excludes):
-                    for dirpath, dirnames, filenames in _walk(path,
-                            follow_symlinks=follow_symlinks):
-                        dir_indeces_to_remove = []
-                        for i, dirname in enumerate(dirnames):
-                            d = join(dirpath, dirname)
-                            if skip_dupe_dirs:
-                                canon_d = normpath(abspath(d))
-                                if follow_symlinks:
-                                    canon_d = realpath(canon_d)
-                                if canon_d in searched_dirs:
-                                    dir_indeces_to_remove.append(i)
-                                    continue
-                                else:
-                                    searched_dirs.add(canon_d)
-                            if dirs == "always" \
-                               and _should_include_path(d, includes, excludes):
-                                yield d
-                            if not _should_include_path(d, [], excludes):
-                                dir_indeces_to_remove.append(i)
-                        for i in reversed(dir_indeces_to_remove):
-                            del dirnames[i]
-                        if files:
-                            for filename in sorted(filenames):
-                                f = join(dirpath, filename)
-                                if _should_include_path(f, includes, excludes):
-                                    yield f
-
-            elif files and _should_include_path(path, includes, excludes):
-                yield path
+                if git_index and files and dir_filter(path):
+                    for f in _paths_from_git_index(path, file_filter,
+                                                   dir_filter):
+                        if seen_files is not None \
+                           and not _is_new_file(seen_files, f):
+                            continue
+                        try:
+                            st = os.stat(f)
+                        except OSError:
+                            _, ex, _ = sys.exc_info()
+                            if ex.errno in (errno.ENOENT, errno.ENOTDIR):
+                                # Tracked, but deleted from the work tree.
+                                log.debug("skip `%s': not in the work tree",
+                                          f)
+                                continue
+                            # The error is reported when it is read.
+                            st = None
+                        if check_size \
+                           and not _is_size_in_range(st, min_size, max_size):
+                            continue
+                        yield with_stat and (f, st) or f
+                elif recursive and dir_filter(path):
+                    for p in _paths_from_walk(path, files, dirs,
+                            file_filter, dir_filter,
+                            searched_dirs=searched_dirs,
+                            seen_files=seen_files,
+                            symlinked_files=symlinked_files,
+                            follow_symlinks=follow_symlinks,
+                            walk_threads=walk_threads, ordered=ordered,
+                            skip_vcs_dirs=skip_vcs_dirs,
+                            respect_gitignore=respect_gitignore,
+                            min_size=min_size, max_size=max_size,
+                            with_stat=with_stat, cache=cache):
+                        yield p
+
+            elif files and file_filter(path):
+                if symlinked_files is not None and islink(path):
+                    symlinked_files.append(path)
+                    continue
+                if seen_files is not None \
+                   and not _is_new_file(seen_files, path):
+                    continue
+                if check_size or with_stat:
+                    st = _stat_or_none(path)
+                    if check_size \
+                       and not _is_size_in_range(st, min_size, max_size):
+                        continue
+                    yield with_stat and (path, st) or path
+                else:
+                    yield path
+
+    for entry in symlinked_files or []:
+        if not _is_new_file(seen_files, entry):
+            continue
+        f = getattr(entry, "path", entry)
+        if check_size or with_stat:
+            try:
+                st = _stat_entry(entry)
+            except OSError:
+                st = None
+            if check_size and not _is_size_in_range(st, min_size, max_size):
+                continue
+            yield with_stat and (f, st) or f
+        else:
+            yield f
+
+def _paths_from_walk(top, files, dirs, file_filter, dir_filter,
+                     searched_dirs=None, seen_files=None,
+                     symlinked_files=None,
+                     follow_symlinks=False, walk_threads=0, ordered=True,
+                     skip_vcs_dirs=False, respect_gitignore=False,
+                     min_size=None, max_size=None, with_stat=False,
+                     cache=None):
+    """Generate the paths under dir `top` for _paths_from_path_patterns().
+
+    "searched_dirs" and "seen_files" are sets of the `(st_dev, st_ino)`
+    of dirs already searched and files already yielded, to skip
+    duplicates, or None to not check for duplicates. If "seen_files" is
+    given, symlinks to files are added to the list "symlinked_files", if
+    given, rather than checked and yielded. See
+    _paths_from_path_patterns() for the other arguments.
+    """
+    from os.path import join
+
+    # With a cache, a dir whose `stat()` signature is unchanged since its
+    # filtered listing was cached isn't listed or filtered again. Filters
+    # are part of the cache key, and so is the searched dir if there are
+    # patterns with a '/' (matched relative to it). Listings aren't cached
+    # with "respect_gitignore" (a change to a ".gitignore" above a dir
+    # doesn't change the dir) or when yielding dirs.
+    lister = None
+    dir_cached = False
+    if cache is not None and files and dirs != "always" \
+       and not respect_gitignore:
+        from os.path import abspath
+        filter_key = repr((file_filter.includes, file_filter.excludes,
+                           dir_filter.excludes, skip_vcs_dirs,
+                           follow_symlinks,
+                           file_filter.has_path_patterns and abspath(top)
+                           or None))
+        # The dirs listed from the cache, and the stat of the others.
+        cached_dirpaths = set()
+        dir_stats = {}
+        def lister(path, follow_symlinks):
+            st = os.stat(path)
+            names = cache.get_dir(path, st, filter_key)
+            if names is None:
+                dir_stats[path] = st
+                return _scandir(path, follow_symlinks)
+            cached_dirpaths.add(path)
+            return ([_CachedDirEntry(path, name) for name in names[0]],
+                    [_CachedDirEntry(path, name) for name in names[1]])
+
+    walker = _dir_walker(top, follow_symlinks=follow_symlinks,
+                         walk_threads=walk_threads, ordered=ordered,
+                         lister=lister)
+
+    # Path patterns are relative to the searched dir.
+    rel_start = len(join(top, ""))
+    use_rel = file_filter.has_path_patterns or respect_gitignore
+    rel_d = rel_f = None
+    check_size = min_size is not None or max_size is not None
+    if respect_gitignore:
+        ignore_rules_from_dir = {top: _gitignores_above(top)}
+    ignore_rules = None
+    # A file's `st_dev` is that of its dir, so identifying a (non-symlink)
+    # file just needs the inode number from the dir listing.
+    if seen_files is not None:
+        try:
+            dev_from_dir = {top: _stat_entry(top).st_dev}
+        except OSError:
+            dev_from_dir = {}
+    dev = None
+
+    for dirpath, dir_entries, file_entries in walker:
+        if respect_gitignore:
+            ignore_rules = ignore_rules_from_dir.pop(dirpath, [])
+            for file_entry in file_entries:
+                if file_entry.name == ".gitignore":
+                    gitignore = _GitIgnore.from_path(file_entry.path)
+                    if gitignore is not None:
+                        rel_dirpath = dirpath[rel_start:]
+                        strip = rel_dirpath and len(rel_dirpath) + 1 or 0
+                        ignore_rules = [(strip, '', gitignore)] + ignore_rules
+                    break
+        if seen_files is not None:
+            dev = dev_from_dir.pop(dirpath, None)
+        if lister is not None:
+            dir_cached = dirpath in cached_dirpaths
+            if dir_cached:
+                cached_dirpaths.discard(dirpath)
+                # The file's `st_dev` comes from its own `stat()`.
+                dev = None
+            else:
+                dir_st = dir_stats.pop(dirpath, None)
+                kept_dirnames, kept_filenames = [], []
+
+        dir_indeces_to_remove = []
+        for i, dir_entry in enumerate(dir_entries):
+            d = dir_entry.path
+            if not dir_cached:
+                if skip_vcs_dirs and dir_entry.name in _VCS_DIR_NAMES:
+                    dir_indeces_to_remove.append(i)
+                    continue
+                if use_rel:
+                    rel_d = d[rel_start:]
+                    if os.sep != '/':
+                        rel_d = rel_d.replace(os.sep, '/')
+                if ignore_rules \
+                   and _is_gitignored(ignore_rules, rel_d, True):
+                    log.debug("skip `%s': ignored by git", d)
+                    dir_indeces_to_remove.append(i)
+                    continue
+                if dirs != "always" and not dir_filter(d, rel_d):
+                    dir_indeces_to_remove.append(i)
+                    continue
+                if lister is not None:
+                    kept_dirnames.append(dir_entry.name)
+            if searched_dirs is not None \
+               and not _is_new_dir(searched_dirs, dir_entry):
+                dir_indeces_to_remove.append(i)
+                continue
+            if dirs == "always":
+                if file_filter(d, rel_d):
+                    yield with_stat and (d, None) or d
+                if not dir_filter(d, rel_d):
+                    dir_indeces_to_remove.append(i)
+        for i in reversed(dir_indeces_to_remove):
+            del dir_entries[i]
+        if respect_gitignore:
+            for dir_entry in dir_entries:
+                ignore_rules_from_dir[dir_entry.path] = ignore_rules
+        if seen_files is not None:
+            for dir_entry in dir_entries:
+                try:
+                    dev_from_dir[dir_entry.path] \
+                        = _stat_entry(dir_entry).st_dev
+                except OSError:
+                    pass
+
+        if files:
+            if ordered:
+                file_entries.sort(key=_entry_name)
+            for file_entry in file_entries:
+                f = file_entry.path
+                if not dir_cached:
+                    if use_rel:
+                        rel_f = f[rel_start:]
+                        if os.sep != '/':
+                            rel_f = rel_f.replace(os.sep, '/')
+                    if ignore_rules \
+                       and _is_gitignored(ignore_rules, rel_f, False):
+                        continue
+                    if not file_filter(f, rel_f):
+                        continue
+                    if lister is not None:
+                        kept_filenames.append(file_entry.name)
+                if seen_files is not None:
+                    if symlinked_files is not None \
+                       and file_entry.is_symlink():
+                        symlinked_files.append(file_entry)
+                        continue
+                    if not _is_new_file(seen_files, file_entry, dev):
+                        continue
+                if check_size or with_stat:
+                    try:
+                        st = file_entry.stat()
+                    except OSError:
+                        st = None
+                    if check_size \
+                       and not _is_size_in_range(st, min_size, max_size):
+                        continue
+                    yield with_stat and (f, st) or f
+                else:
+                    yield f
+            if lister is not None and not dir_cached and dir_st is not None:
+                cache.put_dir(dirpath, dir_st, filter_key,
+                              kept_dirnames, kept_filenames)
 ## end of http://code.activestate.com/recipes/577230/ }}}
 
 
@@ -660,6 +3950,7 @@ class _PerLevelFormatter(logging.Formatter):
             return logging.Formatter.format(self, record)
 
 def _setup_logging():
+    """Log to stdout, with `eol`'s formatting. Return the handler."""
     hdlr = logging.StreamHandler(sys.stdout)
     defaultFmt = "%(name)s: %(lowerlevelname)s: %(message)s"
     fmtFromLevel = {logging.DEBUG: "%(name)s: %(message)s",
@@ -667,6 +3958,57 @@ def _setup_logging():
     fmtr = _PerLevelFormatter(fmt=defaultFmt, fmtFromLevel=fmtFromLevel)
     hdlr.setFormatter(fmtr)
     logging.root.addHandler(hdlr)
+    return hdlr
+
+def _log_eol_info(path, eol, suggested_eol):
+    """Log the given EOL info as `eol` lists it."""
+    if eol is MIXED:
+        log.info("%s: %s, predominantly %s", path,
+            english_name_from_eol(eol),
+            english_name_from_eol(suggested_eol))
+    else:
+        log.info("%s: %s", path, english_name_from_eol(eol))
+
+def _merge_json_paths(paths, json_output=False):
+    """Output the results in the given `eol --json` output files ("-" for
+    stdin) merged into one list sorted by path, as `eol --merge` does.
+    A path in more than one file is listed once (the last result is
+    used). Raise `Error` for a file that can't be opened or a line that
+    isn't such a result.
+    """
+    info_from_path = {}
+    for path in paths:
+        if path == "-":
+            fin = sys.stdin
+        else:
+            try:
+                fin = open(path)
+            except EnvironmentError:
+                _, ex, _ = sys.exc_info()
+                raise Error("%s: %s" % (path, ex.strerror))
+        try:
+            for lineno, line in enumerate(fin):
+                if not line.strip():
+                    continue
+                try:
+                    result_path, info = _eol_info_from_json(line)
+                except (ValueError, KeyError, TypeError):
+                    _, ex, _ = sys.exc_info()
+                    if isinstance(ex, KeyError):
+                        ex = "no %s field" % ex
+                    raise Error("`%s', line %d: not an `eol --json' "
+                                "result: %s" % (path, lineno + 1, ex))
+                info_from_path[result_path] = info
+        finally:
+            if fin is not sys.stdin:
+                fin.close()
+    for path in sorted(info_from_path):
+        info = info_from_path[path]
+        if json_output:
+            print(_json_from_eol_info(path, info))
+        else:
+            _log_eol_info(path, info[0], info[1])
+    return 0
 
 class _NoReflowFormatter(optparse.IndentedHelpFormatter):
     """An optparse formatter that does NOT reflow the description."""
@@ -678,7 +4020,7 @@ class _NoReflowFormatter(optparse.IndentedHelpFormatter):
 #---- mainline
 
 def main(argv=sys.argv):
-    _setup_logging()
+    log_hdlr = _setup_logging()
     log.setLevel(logging.INFO)
 
     # Parse options.
@@ -703,21 +4045,113 @@ def main(argv=sys.argv):
             'NAME must be one of "LF", "CRLF", "CR", "NATIVE", '
             '"NONE", "MIXED" or the "unix", "dos", or "windows" aliases '
             '(case-insensitive)')
+    parser.add_option("--check-final-eol", action="store_true",
+        help="list file(s) that do not end with exactly one EOL, i.e. "
+            "with a missing final EOL or trailing blank lines; exits "
+            "non-zero if any are found")
+    parser.add_option("--fix-final-eol", action="store_true",
+        help="fix file(s) (in-place) to end with exactly one EOL")
+    parser.add_option("--merge", action="store_true",
+        help="merge the given `eol --json` output files (e.g. of each "
+            "--shard) into one report sorted by path")
+    parser.add_option("--json", action="store_true", default=False,
+        help="output a JSON object per file (path, eol, suggested_eol "
+            "and for --check-final-eol, final_eol and "
+            "num_trailing_blank_lines) instead of text")
+    parser.add_option("--shard", metavar="I/N",
+        help="only process the files in shard I (1-based) of N, for "
+            "splitting a run over N machines; files are sharded by a hash "
+            "of their path, or balanced by size for --files-from lists")
     parser.add_option("-r", "--recursive", action="store_true",
         help='recursively search directories', default=False)
     parser.add_option("-x", "--skip", action="append", metavar="PATTERN",
-        help="patterns to excluding in determining files")
+        help="patterns to excluding in determining files; patterns "
+            "with a '/' are matched against the path relative to the "
+            "searched dir, e.g. 'build/**/gen'")
+    parser.add_option("--respect-gitignore", action="store_true",
+        default=False,
+        help="skip files and directories ignored by git (.gitignore and "
+            ".git/info/exclude) when recursing")
+    parser.add_option("--include-vcs-dirs", action="store_true",
+        default=False,
+        help="don't skip VCS metadata directories (.git, .hg, .svn, etc.) "
+            "when recursing")
+    parser.add_option("--git-index", action="store_true", default=False,
+        help="list the files tracked by git under given directories "
+            "(default is the current directory) from the git index "
+            "instead of walking them")
+    parser.add_option("--files-from", metavar="FILE",
+        help="also process the files listed in FILE (one per line, or "
+            "'-' for stdin); listed paths are used as is, without "
+            "globbing or recursing")
+    parser.add_option("-0", "--null", action="store_true", default=False,
+        help="paths in the --files-from list are separated by NULs "
+            "instead of newlines (e.g. from `find -print0` or "
+            "`git diff --name-only -z`)")
+    parser.add_option("--min-size", metavar="SIZE",
+        help="skip files smaller than SIZE bytes; SIZE may have a K, M "
+            "or G suffix (powers of 1024)")
+    parser.add_option("--max-size", metavar="SIZE",
+        help="skip files larger than SIZE bytes, e.g. 10M")
+    parser.add_option("--inode-order", action="store_true", default=False,
+        help="read files in batches in inode order, which can be much "
+            "faster on a cold cache on spinning disks; results are still "
+            "output in the usual order (files of at least --mmap-size "
+            "bytes are read when scanned)")
+    parser.add_option("--read-ahead", metavar="N", type="int", default=0,
+        help="read upcoming files with N threads while scanning, to hide "
+            "the latency of e.g. network filesystems (without -j); files "
+            "of at least --mmap-size bytes are not read ahead")
+    parser.add_option("--cache", metavar="PATH",
+        help="keep scan results in the cache file PATH and only read files "
+            "that changed since (going by size, mtime, ctime and inode); "
+            "not used for converting or fixing")
+    parser.add_option("--stats", action="store_true", default=False,
+        help="report the number of files and bytes read and the read "
+            "throughput at the end")
+    parser.add_option("-j", "--jobs", type="int", metavar="N", default=1,
+        help="scan up to N files at a time; 0 means one per available CPU "
+            "(taking container CPU limits into account)")
+    parser.add_option("--device-jobs", metavar="PATH=N", action="append",
+        default=[], help="with -j, process at most N files at a time from "
+            "the device (filesystem) that PATH is on, instead of the -j "
+            "count, e.g. '--device-jobs /mnt/usb=1' (can be repeated)")
+    parser.add_option("--mmap-size", metavar="SIZE", default="16M",
+        help="scan files of SIZE and up (on local filesystems) by mapping "
+            "them into memory, rather than reading them whole (default 16M)")
+    parser.add_option("--stream-size", metavar="SIZE", default="256M",
+        help="scan and convert files of SIZE and up a chunk at a time "
+            "(default 256M)")
+    parser.add_option("--max-inflight", metavar="SIZE", default="512M",
+        help="with -j, only start converting or fixing a file while the "
+            "files in progress need at most SIZE of memory (default 512M)")
+    parser.add_option("--pool", choices=["thread", "process"],
+        default="thread",
+        help="the kind of workers to use with -j: 'thread' (the default) "
+            "or 'process' to also spread the CPU work over cores")
+    parser.add_option("--walk-threads", type="int", metavar="N", default=0,
+        help="list up to N directories at a time when recursing; can "
+            "help a lot on high-latency filesystems such as NFS")
+    parser.add_option("--unordered", action="store_true", default=False,
+        help="output results as soon as they are found instead of in "
+            "sorted order")
     opts, path_patterns = parser.parse_args()
     log.setLevel(opts.log_level)
+    if opts.json:
+        # Keep stdout for the JSON records.
+        log_hdlr.stream = sys.stderr
     actions = []
     if opts.test: actions.append("test")
     if opts.convert: actions.append("convert")
     if opts.find: actions.append("find")
+    if opts.check_final_eol: actions.append("check-final-eol")
+    if opts.fix_final_eol: actions.append("fix-final-eol")
+    if opts.merge: actions.append("merge")
     if not actions:
         actions = ["list"]
     elif len(actions) > 1:
-        log.error("cannot specify more than one of --convert, --test "
-            "and --find at once")
+        log.error("cannot specify more than one of --convert, --test, "
+            "--find, --check-final-eol, --fix-final-eol and --merge at once")
         return 1
     action = actions[-1]
     log.debug("action: %r" % action)
@@ -728,8 +4162,69 @@ def main(argv=sys.argv):
                 % opts.convert.upper())
     elif action == "find":
         eol = eol_from_name(opts.find.upper())
+    try:
+        min_size = opts.min_size and _size_from_str(opts.min_size)
+        max_size = opts.max_size and _size_from_str(opts.max_size)
+        max_inflight = _size_from_str(opts.max_inflight)
+        mmap_size = _size_from_str(opts.mmap_size)
+        stream_size = _size_from_str(opts.stream_size)
+        device_jobs = _device_jobs_from_strs(opts.device_jobs)
+        shard = opts.shard and _shard_from_str(opts.shard) or None
+    except ValueError:
+        _, ex, _ = sys.exc_info()
+        log.error(str(ex))
+        return 1
+    if action == "merge":
+        try:
+            return _merge_json_paths(path_patterns, json_output=opts.json)
+        except Error:
+            _, ex, _ = sys.exc_info()
+            log.error(str(ex))
+            return 1
+    cache = None
+    if opts.cache and action in ("list", "find", "check-final-eol"):
+        try:
+            cache = _ScanCache(opts.cache)
+        except Error:
+            _, ex, _ = sys.exc_info()
+            log.error(str(ex))
+            return 1
+    path_kwargs = dict(recursive=opts.recursive, excludes=opts.skip,
+        walk_threads=opts.walk_threads, ordered=not opts.unordered,
+        skip_vcs_dirs=not opts.include_vcs_dirs,
+        respect_gitignore=opts.respect_gitignore,
+        git_index=opts.git_index,
+        skip_dupe_dirs=True, skip_dupe_files=True,
+        min_size=min_size, max_size=max_size, with_stat=True, cache=cache)
+    if opts.git_index and not path_patterns and not opts.files_from:
+        path_patterns = [os.curdir]
+    paths = _paths_from_path_patterns(path_patterns, **path_kwargs)
+    if shard is not None:
+        paths = _shard_path_stats(paths, shard)
+    if opts.files_from:
+        from itertools import chain
+        listed_paths = _paths_from_list_file(opts.files_from,
+            sep=(opts.null and "\0" or "\n"))
+        if opts.skip:
+            path_filter = _PathFilter([], opts.skip)
+            listed_paths = (p for p in listed_paths if path_filter(p))
+        listed_paths = _listed_path_stats(listed_paths)
+        if min_size is not None or max_size is not None:
+            listed_paths = ((p, st) for p, st in listed_paths
+                            if _is_size_in_range(st, min_size, max_size))
+        if shard is not None:
+            listed_paths = _shard_path_stats(listed_paths, shard,
+                                             balance=True)
+        paths = chain(paths, listed_paths)
+
+    stats = opts.stats and _ScanStats() or None
+    scan_kwargs = dict(inode_order=opts.inode_order, stats=stats,
+                       cache=cache, jobs=opts.jobs, pool=opts.pool,
+                       read_ahead=opts.read_ahead, device_jobs=device_jobs,
+                       mmap_size=mmap_size, stream_size=stream_size)
 
     # Perform action.
+    retval = 0
     if action == "test":
         log.debug("run eol.py self-test...")
         import doctest
@@ -737,25 +4232,61 @@ def main(argv=sys.argv):
         return results.failed
     elif action == "list":
         for path, eol, suggested_eol \
-                in eol_info_from_path_patterns(path_patterns, opts.recursive,
-                    excludes=opts.skip):
-            if eol is MIXED:
-                log.info("%s: %s, predominantly %s", path,
-                    english_name_from_eol(eol),
-                    english_name_from_eol(suggested_eol))
+                in _eol_info_from_path_stats(paths, **scan_kwargs):
+            if opts.json:
+                print(_json_from_eol_info(path, (eol, suggested_eol)))
             else:
-                log.info("%s: %s", path, english_name_from_eol(eol))
+                _log_eol_info(path, eol, suggested_eol)
     elif action == "convert":
-        for path in _paths_from_path_patterns(path_patterns,
-                recursive=opts.recursive, excludes=opts.skip):
-            convert_path_eol(path, eol)
+        failures = _convert_path_stats_eol(paths, eol, jobs=opts.jobs,
+                                           max_inflight=max_inflight,
+                                           device_jobs=device_jobs,
+                                           stream_size=stream_size)
     elif action == "find":
-        for path, path_eol, suggested_eol in eol_info_from_path_patterns(
-                path_patterns, opts.recursive, excludes=opts.skip):
-            if path_eol == eol:
+        for path, path_eol, suggested_eol \
+                in _eol_info_from_path_stats(paths, **scan_kwargs):
+            if path_eol != eol:
+                pass
+            elif opts.json:
+                print(_json_from_eol_info(path, (path_eol, suggested_eol)))
+            else:
                 log.info("%s", path)
+    elif action == "check-final-eol":
+        num_bad = 0
+        for path, path_eol, suggested_eol, final_eol, num_trailing \
+                in _eol_info_from_path_stats(paths, final_eol=True,
+                                             **scan_kwargs):
+            if final_eol is None:
+                if path_eol is None and not os.path.getsize(path):
+                    continue  # empty files are fine
+            elif not num_trailing:
+                continue
+            num_bad += 1
+            if opts.json:
+                print(_json_from_eol_info(path, (path_eol,
+                    suggested_eol, final_eol, num_trailing)))
+            elif final_eol is None:
+                log.info("%s: no final EOL", path)
+            else:
+                log.info("%s: %d trailing blank line(s)", path, num_trailing)
+        if num_bad:
+            retval = 1
+    elif action == "fix-final-eol":
+        # Empty files are fine (and skipped).
+        failures = _rewrite_path_stats(paths, fix_path_final_eol,
+                                       jobs=opts.jobs,
+                                       max_inflight=max_inflight,
+                                       device_jobs=device_jobs)
+    if action in ("convert", "fix-final-eol") and failures:
+        log.error("%d file(s) could not be %s:", len(failures),
+                  action == "convert" and "converted" or "fixed")
+        for path, ex in failures:
+            log.error("  %s: %s", path, ex.strerror or ex)
+        retval = 1
 
-    return 0
+    if stats is not None:
+        stats.report()
+    return retval
 
 ## {{{ http://code.activestate.com/recipes/577258/ (r4)
 if __name__ == "__main__":
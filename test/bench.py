@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Copyright (c) 2010 ActiveState Software Inc.
+# License: MIT (http://www.opensource.org/licenses/mit-license.php)
+
+"""Some eol benchmarks.
+
+Usage:
+    python bench.py [<benchmark>...]
+
+Benchmarks:
+    walk        the dir walker on deep synthetic trees
+    read_order  scan throughput reading files in name vs inode order, on
+                a cold cache where possible
+
+By default all benchmarks are run.
+"""
+
+import os
+from os.path import join, abspath, dirname
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+import eol
+
+
+
+#---- support stuff
+
+def _timeit(func, repeat=3, setup=None):
+    """Return the best wall time of `repeat` calls to `func`, each after
+    an (untimed) call to `setup`, if given.
+    """
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def _make_deep_tree(top, depth, width=1, files_per_dir=2):
+    """Make a tree with `width` chains of `depth` nested dirs under
+    `top`, with `files_per_dir` files in each dir.
+    """
+    for w in range(width):
+        d = join(top, "w%d" % w)
+        for i in range(depth):
+            os.mkdir(d)
+            for f in range(files_per_dir):
+                open(join(d, "f%d.txt" % f), "wb").close()
+            d = join(d, "d")
+
+def _rmtree(top):
+    # `shutil.rmtree()` recurses, so can't remove the deepest trees.
+    for dirpath, dirnames, filenames in eol._walk(top, topdown=False):
+        for name in filenames:
+            os.remove(join(dirpath, name))
+        for name in dirnames:
+            os.rmdir(join(dirpath, name))
+    os.rmdir(top)
+
+def _evict_from_cache(paths):
+    """Drop the given files from the page cache, if the platform allows.
+    Return False if it doesn't.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+def _walk_entries_recursive(top, follow_symlinks=False):
+    """The recursive-generator walker that `eol._walk_entries()` replaced,
+    for comparison.
+    """
+    try:
+        dirs, nondirs = eol._scandir(top, follow_symlinks)
+    except OSError:
+        return
+    yield top, dirs, nondirs
+    for entry in dirs:
+        for x in _walk_entries_recursive(entry.path, follow_symlinks):
+            yield x
+
+
+
+#---- benchmarks
+
+def bench_walk():
+    print("walk: yielded dirs per second (best of 3)")
+    print("%8s  %14s  %14s" % ("depth", "recursive", "iterative"))
+    tmp = tempfile.mkdtemp()
+    try:
+        for depth in (10, 100, 400, 1500):
+            top = join(tmp, "depth%d" % depth)
+            os.mkdir(top)
+            width = max(1, 2000 // depth)
+            _make_deep_tree(top, depth, width=width)
+            num_dirs = depth * width + 1
+            rates = []
+            for walker in (_walk_entries_recursive, eol._walk_entries):
+                try:
+                    t = _timeit(lambda: [x for x in walker(top)])
+                except RecursionError:
+                    rates.append("RecursionError")
+                else:
+                    rates.append("%.0f" % (num_dirs / t))
+            print("%8d  %14s  %14s" % (depth, rates[0], rates[1]))
+    finally:
+        _rmtree(tmp)
+
+def bench_read_order(num_files=2000, file_size=16 * 1024):
+    print("read_order: scanning %d %dKiB files (best of 3)"
+          % (num_files, file_size // 1024))
+    tmp = tempfile.mkdtemp()
+    try:
+        # Create the files in random name order, so that name order and
+        # inode (roughly, creation) order differ.
+        names = ["f%05d.txt" % i for i in range(num_files)]
+        random.shuffle(names)
+        line = b"x" * 63 + b"\n"
+        content = line * (file_size // len(line))
+        paths = []
+        for name in names:
+            path = join(tmp, name)
+            with open(path, "wb") as f:
+                f.write(content)
+            paths.append(path)
+        if not _evict_from_cache(paths):
+            print("  (can't evict files from the page cache: warm cache)")
+        rates = []
+        for inode_order in (False, True):
+            def scan():
+                for info in eol.eol_info_from_path_patterns([tmp],
+                        recursive=True, inode_order=inode_order):
+                    pass
+            t = _timeit(scan, setup=lambda: _evict_from_cache(paths))
+            rates.append(num_files * file_size / 1048576.0 / t)
+        print("%14s  %10.1f MB/s" % ("name order", rates[0]))
+        print("%14s  %10.1f MB/s  (%.2fx)" % ("inode order", rates[1],
+              rates[1] / rates[0]))
+    finally:
+        _rmtree(tmp)
+
+
+
+#---- mainline
+
+def main(argv):
+    benchmarks = argv[1:] or ["walk", "read_order"]
+    for name in benchmarks:
+        globals()["bench_" + name]()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -36,3 +36,28 @@ class DocTestsTestCase(unittest.TestCase):
         import eol
         doctest.testmod(eol)
 
+
+class EolInfoFromTextsTestCase(unittest.TestCase):
+    def test_numpy_counts(self):
+        """The NumPy batch counts match `bytes.count()` ones"""
+        if sys.version_info[0] == 2:
+            raise TestSkipped("NumPy batch counting is Python 3 only")
+        import eol
+        if eol._eol_counts_from_texts_numpy([b""]) is None:
+            raise TestSkipped("NumPy is not available")
+        import random
+        rand = random.Random(42)
+        # Include texts ending in CR and starting with LF, to check that
+        # CRLFs aren't counted across text boundaries.
+        texts = [bytes(bytearray(rand.choice(b"ab\r\n")
+                       for i in range(rand.randint(0, 20))))
+                 for j in range(300)]
+        expected = []
+        for text in texts:
+            num_crlfs = text.count(b"\r\n")
+            expected.append((num_crlfs, text.count(b"\r") - num_crlfs,
+                             text.count(b"\n") - num_crlfs))
+        self.assertEqual(eol._eol_counts_from_texts_numpy(texts), expected)
+        self.assertEqual(eol.eol_info_from_texts(texts),
+                         [eol.eol_info_from_text(t) for t in texts])
+